@@ -1,56 +1,236 @@
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from django.conf import settings
+from django.db import transaction
 from abc import ABC, abstractmethod
-from binance import Client
-from binance.exceptions import BinanceAPIException
+from RateLimiter import Client
+from unicorn_binance_websocket_api.unicorn_binance_websocket_api_manager import BinanceWebSocketApiManager
 from multipledispatch import dispatch
-from traderboard.models import SnapshotMarket
+from traderboard.models import SnapshotMarket, MarketKlines, MarketSymbols
 import pandas as pd
 import numpy as np
+import threading
+import fcntl
+import time
+import json
+import os
 
 
-class BaseMarket:
-    '''Provide with all the methods exclusively querying the local database.
-       A Market should extend this class to get access to localy stored data.'''
-    
-    def __init__(self, platform):
-        self.platform = platform
+PRICE_FIELDS = ['lastPrice', 'openPrice', 'highPrice', 'lowPrice']
+KLINES_LIMIT = 1000
+KLINES_WORKERS = 8
+MARKET_TTL = getattr(settings, 'MARKET_TTL', 5 * 60)
+MARKET_LIVE = getattr(settings, 'MARKET_LIVE', False)
+EXCHANGE_INFO_TTL = getattr(settings, 'EXCHANGE_INFO_TTL', 24 * 60 * 60)
+INTERVALS = {'1m': 60 * 1000, '1h': 60 * 60 * 1000, '1d': 24 * 60 * 60 * 1000}
+PRICE_ARCHIVE_DIR = getattr(settings, 'PRICE_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archive'))
 
-    def get_price_table(self, asset, base):
-        '''Grab the last Market prices from Market'''
-        last_date = SnapshotMarket.objects.latest('created_at').created_at
-        prices = SnapshotMarket.objects.filter(created_at=last_date)
-        prices = pd.DataFrame.from_records(prices)
-        return prices
 
-    def get_klines(self, symbol, interval, startTime, endTime):
-        # give same output as get_klines
-        # aggregate like in Trader
-        pass
-    
+class PriceArchive:
+    '''On disk archive of the open and close prices of the symbols of a market.
+       Each symbol and interval has its own file: a header holding the open time (in ms) 
+       of the first candle and the interval, followed by one (open, close) float64 row per candle.
+       Files are memory-mapped so that reading a time range does not copy the prices.'''
+    HEADER = 2 * 8 # header is 2 int64
+    ROW = 2 * 8 # a row is 2 float64
 
-class BinanceMarket:
-    '''Market info for Binance'''
+    def __init__(self, platform, path=PRICE_ARCHIVE_DIR):
+        self.path = os.path.join(path, platform)
+
+    def get_file(self, symbol, interval):
+        return os.path.join(self.path, interval, f'{symbol}.f8')
+
+    def read(self, symbol, interval):
+        '''Return the open time of the first archived candle of symbol along with the memory-mapped
+           (open, close) prices of every candle archived since, (None, None) if nothing is archived.'''
+        file = self.get_file(symbol, interval)
+        try:
+            rows = (os.path.getsize(file) - self.HEADER) // self.ROW
+        except OSError:
+            return None, None
+        if rows <= 0:
+            return None, None
+        origin, _ = np.fromfile(file, dtype=np.int64, count=2)
+        prices = np.memmap(file, dtype=np.float64, mode='r', offset=self.HEADER, shape=(rows, 2))
+        return int(origin), prices
+
+    def get_prices(self, symbol, interval, grid):
+        '''Return the position in grid of the first archived candle of grid, along with the (open, close)
+           prices of the archived candles of grid as a view on the archive (empty if none is archived).'''
+        origin, prices = self.read(symbol, interval)
+        if origin is None or len(grid) == 0:
+            return 0, np.empty((0, 2))
+        start = (int(grid[0]) - origin) // INTERVALS[interval]
+        first, end = max(start, 0), min(start + len(grid), len(prices))
+        if end <= first:
+            return 0, np.empty((0, 2))
+        return first - start, prices[first:end]
+
+    def append(self, symbol, interval, open_times, prices):
+        '''Write the (open, close) prices of the candles opened at open_times in the archive of symbol,
+           growing it as needed. Candles missing in between stay NaN.'''
+        if len(open_times) == 0:
+            return
+        step = INTERVALS[interval]
+        open_times = np.asarray(open_times, dtype=np.int64)
+        file = self.get_file(symbol, interval)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            origin, archived = self.read(symbol, interval)
+            if origin is None or open_times.min() < origin:
+                # the archive starts later, write a new file so that readers keep the current one
+                start = open_times.min() if origin is None else min(origin, open_times.min())
+                end = open_times.max() if origin is None else max(origin + (len(archived) - 1) * step, 
+                                                                  open_times.max())
+                data = np.full(((end - start) // step + 1, 2), np.nan)
+                if origin is not None:
+                    data[(origin - start) // step:(origin - start) // step + len(archived)] = archived
+                data[(open_times - start) // step] = prices
+                with open(file + '.tmp', 'wb') as f:
+                    f.write(np.array([start, step], dtype=np.int64).tobytes())
+                    f.write(data.tobytes())
+                os.replace(file + '.tmp', file)
+            else:
+                rows = (open_times - origin) // step
+                if rows.max() >= len(archived):
+                    with open(file, 'r+b') as f:
+                        f.seek(self.HEADER + len(archived) * self.ROW)
+                        f.write(np.full((rows.max() + 1 - len(archived), 2), np.nan).tobytes())
+                archived = np.memmap(file, dtype=np.float64, mode='r+', offset=self.HEADER, 
+                                     shape=(max(rows.max() + 1, len(archived)), 2))
+                archived[rows] = prices
+                archived.flush()
+
+
+class BaseMarket:
+    '''Provide with all the methods exclusively querying the local database.
+       A Market should extend this class to get access to localy stored data.'''
     
     def __init__(self, platform):
-        super().__init__()
         self.platform = platform
         self.bases = ['USDT', 'BTC', 'ETH', 'BNB', 'BUSD']
-    
+
     @classmethod
-    def connect(cls, platform):
+    def connect(cls, platform, date=None):
         self = cls(platform)
-        self.client = Client(None, None)
-        self.timestamp_offset = self.get_timestamp_offset()
-        self.table = self.get_price_table()
+        self.table = self.get_price_table(date)
+        self.index, self.prices = self.get_price_index(self.table)
+        self.symbols = pd.Index(self.index)
+        self.paths = self.get_conversion_paths(self.table)
         return self
 
-    def get_timestamp_offset(self):
-        '''Return offset between API server time and UTC timezone'''
-        server_time = self.client.get_server_time()
-        server_time = server_time['serverTime'] # in ms
-        now = datetime.now(timezone.utc).timestamp()
-        offset = server_time - int(now * 1000)
-        return offset
+    def close(self):
+        '''Release the resources held by the market'''
+        pass
+
+    def is_live(self):
+        '''Tell whether the prices follow the market streams'''
+        return False
+
+    def get_price_table(self, date=None):
+        '''Return the market price table recorded at date, the last recorded one by default'''
+        columns = {'symbol': 'symbol', 
+                   'asset': 'baseAsset', 
+                   'base': 'quoteAsset', 
+                   'price': 'lastPrice', 
+                   'open_price': 'openPrice', 
+                   'high_price': 'highPrice', 
+                   'low_price': 'lowPrice'}
+        snaps = SnapshotMarket.objects.filter(platform=self.platform)
+        if date:
+            snaps = snaps.filter(created_at__lte=date)
+        last_snap = snaps.order_by('-created_at').first()
+        if last_snap is None:
+            print(f"No market prices recorded for {self.platform} before {date}.")
+            return pd.DataFrame(columns=list(columns.values()) + ['price', 'lastId'])
+
+        prices = snaps.filter(created_at=last_snap.created_at).values(*columns.keys())
+        price_table = pd.DataFrame.from_records(prices).rename(columns=columns)
+        for field in ['openPrice', 'highPrice', 'lowPrice']:
+            price_table[field] = price_table[field].fillna(price_table['lastPrice'])
+        price_table = price_table.astype({"symbol": str, 
+                                          "lastPrice": float,
+                                          "openPrice": float,
+                                          "highPrice": float,
+                                          "lowPrice": float})
+        price_table['price'] = price_table['lastPrice']
+        price_table['lastId'] = 1 # recorded symbols were all traded
+        return price_table
+
+    def get_klines(self, symbol, interval, startTime, endTime):
+        '''Return klines of symbol between startTime and endTime (in ms), with the same layout
+           as the klines of the REST API. Candles missing from the kline store are aggregated
+           from the recorded market prices.'''
+        klines = self.get_stored_klines(symbol, interval, startTime, endTime)
+        missing = self.get_missing_ranges(klines, interval, startTime, endTime)
+        if missing:
+            stored = {kline[0] for kline in klines}
+            snap_klines = self.get_snapshot_klines(symbol, interval, missing[0][0], missing[-1][1])
+            klines = sorted(klines + [kline for kline in snap_klines if kline[0] not in stored], 
+                            key=lambda row: row[0])
+        return klines
+
+    def get_stored_klines(self, symbol, interval, startTime, endTime):
+        '''Return the stored klines of symbol between startTime and endTime (in ms)'''
+        klines = MarketKlines.objects.filter(platform=self.platform, symbol=symbol, interval=interval)\
+                                     .filter(open_time__range=[startTime, endTime])\
+                                     .order_by('open_time')\
+                                     .values_list('open_time',
+                                                  'open_price',
+                                                  'high_price',
+                                                  'low_price',
+                                                  'close_price',
+                                                  'volume',
+                                                  'close_time')
+        return [list(kline) for kline in klines]
+
+    def get_snapshot_klines(self, symbol, interval, startTime, endTime):
+        '''Aggregate the market prices of symbol recorded between startTime and endTime (in ms) in klines'''
+        prices = SnapshotMarket.objects.filter(platform=self.platform, symbol=symbol)\
+                                       .filter(created_at__range=[Market.to_datetime(startTime), 
+                                                                  Market.to_datetime(endTime)])\
+                                       .order_by('created_at')\
+                                       .values('created_at', 'price')
+        prices = pd.DataFrame.from_records(prices)
+        if prices.empty:
+            return []
+        step = INTERVALS[interval]
+        prices['price'] = prices['price'].astype(float)
+        prices['open_time'] = Market.to_timestamps(prices['created_at']) // step * step
+        klines = prices.groupby('open_time')['price'].agg(['first', 'max', 'min', 'last']).reset_index()
+        return [[int(open_time), open_price, high_price, low_price, close_price, 0.0, int(open_time) + step - 1]
+                for open_time, open_price, high_price, low_price, close_price 
+                in zip(klines['open_time'], klines['first'], klines['max'], klines['min'], klines['last'])]
+
+    def save_klines(self, symbol, interval, klines):
+        '''Record closed klines of symbol in local database, ignoring the ones already stored.'''
+        klines = [MarketKlines(platform=self.platform,
+                               symbol=symbol,
+                               interval=interval,
+                               open_time=kline[0],
+                               open_price=kline[1],
+                               high_price=kline[2],
+                               low_price=kline[3],
+                               close_price=kline[4],
+                               volume=kline[5],
+                               close_time=kline[6])
+                  for kline in klines]
+        MarketKlines.objects.bulk_create(klines, ignore_conflicts=True)
+
+    def get_missing_ranges(self, klines, interval, startTime, endTime, empty=()):
+        '''Return the (start, end) time ranges of the candles missing in klines between startTime and endTime.
+           Candles of the <empty> (start, end) ranges are known not to exist, they are not missing.'''
+        step = INTERVALS[interval]
+        grid = self.get_time_grid(interval, startTime, endTime)
+        missing = np.setdiff1d(grid, [kline[0] for kline in klines])
+        for start, end in empty:
+            missing = missing[(missing < start) | (missing > end)]
+        if missing.size == 0:
+            return []
+        missing = np.split(missing, np.where(np.diff(missing) > step)[0] + 1)
+        return [(int(times[0]), int(times[-1]) + step - 1) for times in missing]
 
     def round_date(self, date, interval, mode='open'):
         if interval == '1m':
@@ -70,132 +250,165 @@ class BinanceMarket:
                 date = date.replace(microsecond=999999, second=59, minute=59, hour=23, tzinfo=timezone.utc)
         return date
 
-    def get_timestamp_range(self, date_from, date_to, interval, mode='open'):
-        start = self.round_date(date_from, interval, mode)
-        end = self.round_date(date_to, interval, mode)
-        ts = pd.date_range(start=start, end=end, freq=interval)
-        ts = ts.astype(np.int64) // 10 ** 6
-        return ts
+    def get_time_grid(self, interval, startTime, endTime):
+        '''Return the open times (in ms) of the candles of interval between startTime and endTime'''
+        step = INTERVALS[interval]
+        return np.arange(-(-startTime // step) * step, endTime + 1, step, dtype=np.int64)
 
-    def get_price_table(self):
-        '''Return current market price table'''
-        prices = self.client.get_ticker()
-        price_table = pd.DataFrame(prices)
-        price_table['price'] = price_table['lastPrice']
-        price_table = price_table.astype({"symbol": str, 
-                                          "lastPrice": float,
-                                          "openPrice": float,
-                                          "highPrice": float,
-                                          "lowPrice": float})
+    def get_price_index(self, table):
+        '''Index the prices of the traded symbols of <table> for constant time lookups.
+           Return the position of each symbol in the price array and the price array
+           (lastPrice, openPrice, highPrice, lowPrice).'''
+        traded = table[table['lastId'] > 0].drop_duplicates('symbol')
+        index = {symbol: i for i, symbol in enumerate(traded['symbol'])}
+        prices = traded[PRICE_FIELDS].to_numpy(dtype=np.float64)
+        return index, prices
 
-        symbol_info = self.client.get_exchange_info()
-        symbol_info = symbol_info['symbols']
-        symbol_cols = ['symbol', 'baseAsset', 'quoteAsset', 'baseAssetPrecision', 'quoteAssetPrecision']
-        symbol_info = [{key: info[key] for key in symbol_cols} for info in symbol_info]
-        symbol_table = pd.DataFrame(symbol_info)
+    def get_conversion_paths(self, table):
+        '''Return, for each base, the conversion paths of every asset to that base.
+           Paths are the shortest ones in the graph of traded symbols, most traded symbols first.
+           Paths are stored as the positions of their symbols in the price array (padded with -1),
+           with a flag telling if the price of the symbol must be inverted.'''
+        traded = table[table['lastId'] > 0].drop_duplicates('symbol')
+        if 'count' in traded:
+            liquidity = traded['count'].to_numpy(dtype=np.float64)
+        else:
+            liquidity = np.zeros(len(traded))
+        neighbors = defaultdict(list)
+        for i in np.argsort(-liquidity, kind='stable'):
+            position = self.index[traded['symbol'].iat[i]]
+            asset, quote = traded['baseAsset'].iat[i], traded['quoteAsset'].iat[i]
+            neighbors[quote].append((asset, position, False))
+            neighbors[asset].append((quote, position, True))
+
+        paths = {}
+        for base in self.bases:
+            # walk the graph backward from base, each asset keeps the first path found
+            steps = {base: []}
+            frontier = [base]
+            while frontier:
+                next_frontier = []
+                for target in frontier:
+                    for asset, position, inverse in neighbors[target]:
+                        if asset not in steps:
+                            steps[asset] = [(position, inverse)] + steps[target]
+                            next_frontier.append(asset)
+                frontier = next_frontier
+
+            length = max(len(path) for path in steps.values())
+            positions = np.full((len(steps), length), -1)
+            inversions = np.zeros((len(steps), length), dtype=bool)
+            for row, path in enumerate(steps.values()):
+                for col, (position, inverse) in enumerate(path):
+                    positions[row, col] = position
+                    inversions[row, col] = inverse
+            paths[base] = (pd.Index(steps.keys()), positions, inversions)
+        return paths
+
+    def get_conversion_path(self, asset, base):
+        '''Return the symbols to walk through to convert asset to base, along with
+           whether their price must be inverted. Return None if there is no path.'''
+        assets, positions, inversions = self.paths[base]
+        if asset not in assets:
+            return None
+        row = assets.get_loc(asset)
+        return [(self.symbols[position], inverse) 
+                for position, inverse in zip(positions[row], inversions[row]) if position >= 0]
+
+    def convert(self, positions, inversions):
+        '''Return the prices obtained by walking along the conversion paths'''
+        factors = np.ones(positions.shape + (len(PRICE_FIELDS),))
+        steps = positions >= 0
+        factors[steps] = self.prices[positions[steps]]
+        with np.errstate(divide='ignore'):
+            factors[inversions] = 1.0 / factors[inversions]
+        return factors.prod(axis=1)
 
-        price_table = price_table.merge(symbol_table, on='symbol')
-        return price_table.drop_duplicates()
-    
     def get_price(self, asset, base):
         '''Return price of asset w.r.t base'''
         assert base in self.bases, f"{base} not supported as an exchange base."
-        if asset == base:
-            price = {"lastPrice": 1.0, 
-                     "openPrice": 1.0, 
-                     "highPrice": 1.0, 
-                     "lowPrice": 1.0}
+        assets, positions, inversions = self.paths[base]
+        if asset in assets:
+            row = assets.get_loc(asset)
+            price = self.convert(positions[row:row + 1], inversions[row:row + 1])[0]
         else:
-            symbol = asset + base
-            res = self.table[(self.table['symbol'] == symbol) & (self.table['lastId'] > 0)]
-            if res.empty:
-                symbol = base + asset
-                res = self.table[(self.table['symbol'] == symbol) & (self.table['lastId'] > 0)]
-                if res.empty:
-                    other_symbols = [asset + other_base for other_base in self.bases]
-                    others = self.table[(self.table['symbol'].isin(other_symbols)) & (self.table['lastId'] > 0)]
-                    if others.empty:
-                        print(f"Asset {asset} seems to have no exchange with one of the supported bases {self.bases}.")
-                        price = {"lastPrice": 0.0, 
-                                 "openPrice": 0.0, 
-                                 "highPrice": 0.0, 
-                                 "lowPrice": 0.0}
-                    else:
-                        alt_base = others.iloc[0]['quoteAsset']
-                        alt_price = others.iloc[0][['lastPrice', 'openPrice', 'highPrice', 'lowPrice']].to_dict()
-                        base_price = self.get_price(alt_base, base)
-                        price = {k: alt_price[k] * base_price[k] for k in alt_price.keys()}
-                else:
-                    price = {"lastPrice": 1.0 / float(res['lastPrice']), 
-                             "openPrice": 1.0 / float(res['openPrice']), 
-                             "highPrice": 1.0 / float(res['highPrice']), 
-                             "lowPrice": 1.0 / float(res['lowPrice'])}
-            else:
-                price = {"lastPrice": float(res['lastPrice']), 
-                         "openPrice": float(res['openPrice']), 
-                         "highPrice": float(res['highPrice']), 
-                         "lowPrice": float(res['lowPrice'])}
-        return price
+            print(f"Asset {asset} seems to have no exchange with one of the supported bases {self.bases}.")
+            price = np.zeros(len(PRICE_FIELDS))
+        return {k: float(v) for k, v in zip(PRICE_FIELDS, price)}
+
+    def get_prices(self, assets, base):
+        '''Return prices of every asset of <assets> w.r.t base, in a table aligned with <assets>'''
+        assert base in self.bases, f"{base} not supported as an exchange base."
+        assets = pd.Series(assets, dtype=object).reset_index(drop=True)
+        path_assets, positions, inversions = self.paths[base]
+        rows = path_assets.get_indexer(assets)
+        found = rows >= 0
+        prices = np.zeros((len(assets), len(PRICE_FIELDS)))
+        prices[found] = self.convert(positions[rows[found]], inversions[rows[found]])
+        for asset in assets[~found]:
+            print(f"Asset {asset} seems to have no exchange with one of the supported bases {self.bases}.")
+
+        prices = pd.DataFrame(prices, columns=PRICE_FIELDS)
+        prices.insert(0, 'asset', assets)
+        return prices
+
+    def get_price_series(self, asset, base, interval, startTime, endTime):
+        '''Return the open and close prices of asset w.r.t base for every candle of interval
+           between startTime and endTime (in ms), as float64 arrays aligned with the time grid.
+           Candles missing for one of the symbols of the conversion path are NaN.'''
+        assert base in self.bases, f"{base} not supported as an exchange base."
+        grid = self.get_time_grid(interval, startTime, endTime)
+        open_prices = np.ones(len(grid))
+        close_prices = np.ones(len(grid))
+        if asset == base:
+            return grid, open_prices, close_prices
+
+        path = self.get_conversion_path(asset, base)
+        if path is None:
+            print(f"Asset {asset} seems to have no exchange with one of the supported bases {self.bases}.")
+            return grid, np.zeros(len(grid)), np.zeros(len(grid))
+
+        for symbol, inverse in path:
+            step = self.get_symbol_prices(symbol, interval, grid)
+            if inverse:
+                with np.errstate(divide='ignore'):
+                    step = 1.0 / step
+            open_prices *= step[:, 0]
+            close_prices *= step[:, 1]
+        return grid, open_prices, close_prices
+
+    def get_symbol_prices(self, symbol, interval, grid):
+        '''Return the (open, close) prices of symbol for the candles opened at the times of grid, NaN if missing'''
+        prices = np.full((len(grid), 2), np.nan)
+        if len(grid) == 0:
+            return prices
+        klines = self.get_klines(symbol, interval, int(grid[0]), int(grid[-1]) + INTERVALS[interval] - 1)
+        if klines:
+            klines = np.array([(kline[0], kline[1], kline[4]) for kline in klines], dtype=np.float64)
+            open_times = klines[:, 0].astype(np.int64)
+            rows = np.searchsorted(grid, open_times).clip(max=len(grid) - 1)
+            found = grid[rows] == open_times
+            prices[rows[found]] = klines[found, 1:]
+        return prices
+
+    def fill_gaps(self, prices):
+        '''Linearly interpolate the missing (NaN) prices, edges take the closest known price'''
+        missing = np.isnan(prices)
+        if missing.any() and not missing.all():
+            positions = np.arange(len(prices))
+            prices[missing] = np.interp(positions[missing], positions[~missing], prices[~missing])
+        return prices
 
     def get_price_history(self, asset, base, date_from, date_to, interval):
         '''Return price history of asset w.r.t base between date_from and date_to'''
-        assert base in self.bases, f"{base} not supported as an exchange base."
         start = Market.to_timestamp(self.round_date(date_from, interval, 'open'))
         end = Market.to_timestamp(self.round_date(date_to, interval, 'close'))
-        prices = pd.DataFrame(columns=['open_time', 'open_price'])
-        time_range = pd.DataFrame({
-                     'open_time': self.get_timestamp_range(date_from, date_to, interval, 'open'),
-                     'close_time': self.get_timestamp_range(date_from, date_to, interval, 'close')
-                    })
-        prices['open_time'] = time_range['open_time']
-        prices['close_time'] = time_range['close_time']
-        if asset == base:
-            prices['open_price'] = 1.0
-            prices['close_price'] = 1.0
-        else:
-            symbol = asset + base
-            try:
-                res = self.client.get_klines(symbol=symbol, interval=interval, startTime=start, endTime=end, limit=1000)
-                prices = pd.DataFrame(
-                            [(int(row[0]), float(row[1]), int(row[6]), float(row[4])) for row in res], 
-                            columns=['open_time', 'open_price', 'close_time', 'close_price'])
-            except BinanceAPIException:
-                symbol = base + asset
-                try:
-                    res = self.client.get_klines(symbol=symbol, interval=interval, startTime=start, endTime=end, limit=1000)
-                    prices = pd.DataFrame(
-                                [(int(row[0]), float(row[1]), int(row[6]), float(row[4])) for row in res], 
-                                columns=['open_time', 'open_price', 'close_time', 'close_price'])
-                    prices['open_price'] = 1.0 / prices['open_price']
-                    prices['close_price'] = 1.0 / prices['close_price']
-                except BinanceAPIException:
-                    other_symbols = [asset + other_base for other_base in self.bases]
-                    others = self.table[self.table['symbol'].isin(other_symbols)]
-                    if others.empty:
-                        print(f"Asset {asset} seems to have no exchange with one of the supported bases {self.bases}.")
-                        prices['open_price'] = 0.0
-                        prices['close_price'] = 0.0
-                    else:
-                        alt_symb = others.iloc[0]['symbol']
-                        alt_base = alt_symb.split(asset, 1)[1]
-                        try:
-                            res = self.client.get_klines(symbol=alt_symb, interval=interval, startTime=start, endTime=end, limit=1000)
-                            prices = pd.DataFrame(
-                                        [(int(row[0]), float(row[1]), int(row[6]), float(row[4])) for row in res], 
-                                        columns=['open_time', 'open_price', 'close_time', 'close_price'])
-                            price_hist = self.get_price_history(alt_base, base, date_from, date_to, interval)
-                            prices = prices.merge(price_hist, 'inner', on=['open_time', 'close_time'])
-                            prices['open_price'] = prices['open_price_x'] * prices['open_price_y']
-                            prices['close_price'] = prices['close_price_x'] * prices['close_price_y']
-                        except BinanceAPIException:
-                            print(f"Asset {asset} seems to have no exchange with base {alt_base}\
-                                between {date_from} and {date_to}.")
-                            prices['open_price'] = 0.0
-                            prices['close_price'] = 0.0
-        # interpolate prices if wholes in query 
-        prices = prices.merge(time_range, how='right', on=['open_time', 'close_time'])
-        prices['open_price'] = prices['open_price'].interpolate(method='linear').fillna(method='backfill')
-        prices['close_price'] = prices['close_price'].interpolate(method='linear').fillna(method='backfill')
+        open_times, open_prices, close_prices = self.get_price_series(asset, base, interval, start, end)
+        # interpolate prices if wholes in query
+        prices = pd.DataFrame({'open_time': open_times,
+                               'open_price': self.fill_gaps(open_prices),
+                               'close_time': open_times + INTERVALS[interval] - 1,
+                               'close_price': self.fill_gaps(close_prices)})
         prices['asset'] = asset
         prices['base'] = base
         prices['symbol'] = asset + base
@@ -203,69 +416,268 @@ class BinanceMarket:
 
     def get_daily_prices(self, asset, base, date_from, date_to):
         '''Return daily prices of asset w.r.t base between date_from and date_to'''
-        assert base in self.bases, f"{base} not supported as an exchange base."
         start = Market.to_timestamp(date_from)
         end = Market.to_timestamp(date_to)
-        if asset == base:
-            prices = pd.DataFrame(columns=['close_date', 'close_price'])
-            prices['close_date'] = pd.date_range(start=date_from, end=date_to)
-            prices['close_price'] = 1.0
+        open_times, _, close_prices = self.get_price_series(asset, base, '1d', start, end)
+        found = ~np.isnan(close_prices)
+        prices = pd.DataFrame({'close_time': open_times[found] + INTERVALS['1d'] - 1,
+                               'close_price': close_prices[found]})
+        prices['close_date'] = Market.to_dates(prices['close_time'])
+        return prices
+
+
+class BinanceMarket(BaseMarket):
+    '''Market info for Binance'''
+    # ranges of closed candles without kline (e.g. before listing) per (symbol, interval), shared by the process
+    _empty_ranges = defaultdict(set)
+    
+    @classmethod
+    def connect(cls, platform, live=False):
+        self = cls(platform)
+        self.client = Client(None, None)
+        self.archive = PriceArchive(platform)
+        self.timestamp_offset = self.get_timestamp_offset()
+        self.table = self.get_price_table()
+        self.index, self.prices = self.get_price_index(self.table)
+        self.symbols = pd.Index(self.index)
+        self.paths = self.get_conversion_paths(self.table)
+        self.stream_manager = None
+        if live:
+            self.stream_prices()
+        return self
+
+    def close(self):
+        '''Stop streaming prices'''
+        if self.stream_manager:
+            self.stream_manager.stop_manager_with_all_streams()
+
+    def is_live(self):
+        return self.stream_manager is not None and not self.stream_manager.is_manager_stopping()
+
+    def stream_prices(self):
+        '''Subscribe to the all market mini ticker stream to keep prices up to date.
+           Only the price array is updated, the price table keeps the connection prices.'''
+        self.stream_manager = BinanceWebSocketApiManager(exchange="binance.com")
+        stream_id = self.stream_manager.create_stream('arr', '!miniTicker', stream_buffer_name=True)
+        worker_thread = threading.Thread(target=self.update_prices, args=(stream_id,), daemon=True)
+        worker_thread.start()
+
+    def update_prices(self, stream_id):
+        '''Apply the mini ticker updates received on stream_id to the price array in place'''
+        while not self.stream_manager.is_manager_stopping():
+            stream_data = self.stream_manager.pop_stream_data_from_stream_buffer(stream_id)
+            if stream_data is False:
+                time.sleep(0.01)
+                continue
+            tickers = json.loads(stream_data)
+            if not isinstance(tickers, list):
+                # subscription results carry no price
+                continue
+            for ticker in tickers:
+                position = self.index.get(ticker['s'])
+                if position is not None:
+                    self.prices[position] = [float(ticker['c']), 
+                                             float(ticker['o']), 
+                                             float(ticker['h']), 
+                                             float(ticker['l'])]
+
+    def get_timestamp_offset(self):
+        '''Return offset between API server time and UTC timezone'''
+        server_time = self.client.get_server_time()
+        server_time = server_time['serverTime'] # in ms
+        now = datetime.now(timezone.utc).timestamp()
+        offset = server_time - int(now * 1000)
+        return offset
+
+    def get_price_table(self):
+        '''Return current market price table'''
+        prices = self.client.get_ticker()
+        price_table = pd.DataFrame(prices)
+        price_table['price'] = price_table['lastPrice']
+        price_table = price_table.astype({"symbol": str, 
+                                          "lastPrice": float,
+                                          "openPrice": float,
+                                          "highPrice": float,
+                                          "lowPrice": float})
+
+        traded = price_table.loc[price_table['lastId'] > 0, 'symbol']
+        symbol_table = self.get_symbol_table(traded)
+        price_table = price_table.merge(symbol_table, on='symbol')
+        return price_table.drop_duplicates()
+
+    def get_symbol_table(self, symbols=()):
+        '''Return the table of the symbols listed on the market. The table is read from local database
+           and only downloaded again when older than EXCHANGE_INFO_TTL or missing one of <symbols>.'''
+        columns = {'symbol': 'symbol', 
+                   'asset': 'baseAsset', 
+                   'base': 'quoteAsset', 
+                   'asset_precision': 'baseAssetPrecision', 
+                   'base_precision': 'quoteAssetPrecision'}
+        records = MarketSymbols.objects.filter(platform=self.platform)
+        symbol_table = pd.DataFrame.from_records(records.values('updated_at', *columns.keys()))
+        if symbol_table.empty:
+            outdated = True
         else:
-            symbol = asset + base
-            try:
-                res = self.client.get_klines(symbol=symbol, interval='1d', startTime=start, endTime=end)
-                prices = pd.DataFrame(
-                        [(row[6], float(row[4])) for row in res], columns=['close_time', 'close_price'])
-                prices['close_date'] = prices['close_time'].apply(lambda ts: Market.to_date(ts))
-            except BinanceAPIException:
-                symbol = base + asset
-                try:
-                    res = self.client.get_klines(symbol=symbol, interval='1d', startTime=start, endTime=end)
-                    prices = pd.DataFrame(
-                        [(row[6], float(row[4])) for row in res], columns=['close_time', 'close_price'])
-                    prices['close_date'] = prices['close_time'].apply(lambda ts: Market.to_date(ts))
-                    prices['close_price'] = 1.0 / prices['close_price']
-                except BinanceAPIException:
-                    other_symbols = [asset + other_base for other_base in self.bases]
-                    others = self.table[self.table['symbol'].isin(other_symbols)]
-                    if others.empty:
-                        print(f"Asset {asset} seems to have no exchange with one of the supported bases {self.bases}.")
-                        prices = pd.DataFrame(columns=['close_date', 'close_price'])
-                        prices['close_date'] = pd.date_range(start=Market.to_date(date_from), end=Market.to_date(date_to))
-                        prices['close_price'] = 0.0
-                    else:
-                        alt_symb = others.iloc[0]['symbol']
-                        alt_base = alt_symb.split(asset, 1)[1]
-                        try:
-                            res = self.client.get_klines(symbol=alt_symb, interval='1d', startTime=start, endTime=end)
-                            prices = pd.DataFrame(
-                                    [(row[6], float(row[4])) for row in res], columns=['close_time', 'close_price'])
-                            prices['close_date'] = prices['close_time'].apply(lambda ts: Market.to_date(ts))
-                            price_hist = self.get_daily_prices(alt_base, base, date_from, date_to)
-                            prices = prices.merge(price_hist, 'inner', on='close_date')
-                            prices['close_price'] = prices['close_price_x'] * prices['close_price_y']
-                        except BinanceAPIException:
-                            print(f"Asset {asset} seems to have no exchange with base {alt_base}\
-                                between {date_from} and {date_to}.")
-                            prices = pd.DataFrame(columns=['close_date', 'close_price'])
-                            prices['close_date'] = pd.date_range(start=Market.to_date(date_from), end=Market.to_date(date_to))
-                            prices['close_price'] = 0.0
+            age = datetime.now(timezone.utc) - symbol_table['updated_at'].min().to_pydatetime()
+            outdated = age.total_seconds() > EXCHANGE_INFO_TTL or not set(symbols) <= set(symbol_table['symbol'])
+        if outdated:
+            return self.load_symbol_table()
+        return symbol_table[list(columns.keys())].rename(columns=columns)
+
+    def load_symbol_table(self):
+        '''Download the table of the symbols listed on the market and record it in local database'''
+        symbol_info = self.client.get_exchange_info()
+        symbol_info = symbol_info['symbols']
+        symbol_cols = ['symbol', 'baseAsset', 'quoteAsset', 'baseAssetPrecision', 'quoteAssetPrecision']
+        symbol_info = [{key: info[key] for key in symbol_cols} for info in symbol_info]
+        symbol_table = pd.DataFrame(symbol_info)
+
+        now = datetime.now(timezone.utc)
+        symbols = [MarketSymbols(updated_at=now,
+                                 platform=self.platform,
+                                 symbol=info['symbol'],
+                                 asset=info['baseAsset'],
+                                 base=info['quoteAsset'],
+                                 asset_precision=info['baseAssetPrecision'],
+                                 base_precision=info['quoteAssetPrecision'])
+                   for info in symbol_info]
+        # several processes may refresh the table at the same time: insert the new symbols,
+        # update the recorded ones and delete the delisted ones, without any duplicate conflict
+        listed = {symbol.symbol: symbol for symbol in symbols}
+        fields = ['asset', 'base', 'asset_precision', 'base_precision']
+        with transaction.atomic():
+            MarketSymbols.objects.bulk_create(symbols, ignore_conflicts=True)
+            records = MarketSymbols.objects.filter(platform=self.platform).order_by('symbol')
+            delisted, changed = [], []
+            for record in records:
+                symbol = listed.get(record.symbol)
+                if symbol is None:
+                    delisted.append(record.id)
+                elif any(getattr(record, field) != getattr(symbol, field) for field in fields):
+                    for field in fields:
+                        setattr(record, field, getattr(symbol, field))
+                    changed.append(record)
+            MarketSymbols.objects.filter(id__in=delisted).delete()
+            MarketSymbols.objects.bulk_update(changed, fields, batch_size=500)
+            records.update(updated_at=now)
+        return symbol_table
+
+    def fetch_klines(self, symbol, interval, ranges):
+        '''Request klines of symbol over the (start, end) time ranges to the REST API.
+           Ranges are split in pages of KLINES_LIMIT candles that are fetched concurrently.'''
+        page_size = INTERVALS[interval] * KLINES_LIMIT
+        pages = [(start, min(start + page_size - 1, end))
+                 for range_start, end in ranges
+                 for start in range(range_start, end + 1, page_size)]
+
+        def fetch_page(page):
+            return self.client.get_klines(symbol=symbol, interval=interval, 
+                                          startTime=page[0], endTime=page[1], limit=KLINES_LIMIT)
+
+        with ThreadPoolExecutor(max_workers=min(KLINES_WORKERS, len(pages))) as pool:
+            res = [row for page in pool.map(fetch_page, pages) for row in page]
+
+        # stitch pages together, candles are identified by their open time
+        klines = {int(row[0]): [int(row[0]), float(row[1]), float(row[2]), float(row[3]), 
+                                float(row[4]), float(row[5]), int(row[6])]
+                  for row in res}
+        return [klines[open_time] for open_time in sorted(klines)]
+
+    def get_symbol_prices(self, symbol, interval, grid):
+        '''Return the (open, close) prices of symbol for the candles opened at the times of grid.
+           Prices are sliced from the archive, only the candles missing from it are collected 
+           from the klines, and archived once closed.'''
+        offset, archived = self.archive.get_prices(symbol, interval, grid)
+        if offset == 0 and len(archived) == len(grid) and not np.isnan(archived).any():
+            return archived
+
+        prices = np.full((len(grid), 2), np.nan)
+        prices[offset:offset + len(archived)] = archived
+        missing = np.isnan(prices).any(axis=1)
+        rows = np.flatnonzero(missing)
+        for run in np.split(rows, np.where(np.diff(rows) > 1)[0] + 1):
+            prices[run] = super().get_symbol_prices(symbol, interval, grid[run])
+
+        # only archive the closed candles that were missing from the archive
+        now = Market.to_timestamp(datetime.now(timezone.utc)) + self.timestamp_offset
+        closed = missing & (grid + INTERVALS[interval] - 1 < now) & ~np.isnan(prices).any(axis=1)
+        self.archive.append(symbol, interval, grid[closed], prices[closed])
         return prices
 
+    def get_klines(self, symbol, interval, startTime, endTime):
+        '''Return klines of symbol between startTime and endTime (in ms). Klines are read
+           from local database first, only the missing ones are requested to the REST API.'''
+        # candles opening after the current one do not exist yet
+        now = Market.to_timestamp(datetime.now(timezone.utc)) + self.timestamp_offset
+        endTime = min(endTime, now)
+        klines = self.get_stored_klines(symbol, interval, startTime, endTime)
+        empty = self._empty_ranges[(symbol, interval)]
+        missing = self.get_missing_ranges(klines, interval, startTime, endTime, empty)
+        if missing:
+            res = self.fetch_klines(symbol, interval, missing)
+            # only closed candles are recorded, the current one is still moving
+            self.save_klines(symbol, interval, [row for row in res if row[6] < now])
+            klines = sorted(klines + res, key=lambda row: row[0])
+            # remember the closed candles the API has no kline for, not to request them again
+            closed_end = now // INTERVALS[interval] * INTERVALS[interval] - 1
+            for start, end in missing:
+                empty.update(self.get_missing_ranges(res, interval, start, min(end, closed_end)))
+        return klines
+
 
 class Market:
+    # markets shared by the whole process, see Market.shared
+    _shared = {}
+    _shared_lock = threading.Lock()
+
     def __init__(self):
         self._markets = {
             'Binance': BinanceMarket,
         }
     
     @classmethod
-    def connect(cls, platform):
+    def connect(cls, platform, offline=False, date=None, live=False):
+        '''Connect to the market of platform. An offline market only serves the prices
+           recorded in local database, at date if provided. A live market keeps its prices
+           up to date with the market streams.'''
         self = cls()
         market = self._markets[platform]
         if not market:
             raise ValueError(f'Platform not supported - {platform}')
-        return market.connect(platform)
+        if offline:
+            return BaseMarket.connect(platform, date)
+        return market.connect(platform, live)
+
+    @classmethod
+    def shared(cls, platform, offline=False):
+        '''Return the market of platform shared by the whole process.
+           The shared market is reconnected in background, see Market.refresh_shared.'''
+        key = (platform, offline)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls.connect(platform, offline, live=MARKET_LIVE and not offline)
+                refresher = threading.Thread(target=cls.refresh_shared, args=(platform, offline), daemon=True)
+                refresher.start()
+        return cls._shared[key]
+
+    @classmethod
+    def refresh_shared(cls, platform, offline=False):
+        '''Replace the shared market of platform by a fresh one every MARKET_TTL seconds.
+           A live market already follows the prices, it is only replaced every EXCHANGE_INFO_TTL
+           seconds to pick up the new symbols, or as soon as its stream stopped.'''
+        live = MARKET_LIVE and not offline
+        connected_at = time.time()
+        while True:
+            time.sleep(MARKET_TTL)
+            market = cls._shared[(platform, offline)]
+            if live and market.is_live() and time.time() - connected_at < EXCHANGE_INFO_TTL:
+                continue
+            try:
+                cls._shared[(platform, offline)] = cls.connect(platform, offline, live=live)
+                connected_at = time.time()
+                market.close()
+            except Exception as e:
+                print(f'Refresh of the shared {platform} market failed.\nRoot error: {e}')
 
     @staticmethod
     @dispatch(datetime)
@@ -308,6 +720,22 @@ class Market:
     def to_date(timestamp):
         # convert server timestamp to UTC date-like object
         date = Market.to_datetime(timestamp)
-        return datetime.combine(date, datetime.min.time(), timezone.utc)         
+        return datetime.combine(date, datetime.min.time(), timezone.utc)
+
+    @staticmethod
+    def to_timestamps(dts):
+        # convert a series of str dates or datetimes to UTC timestamps, in ms
+        dts = pd.to_datetime(pd.Series(dts), utc=True)
+        return (dts - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(1, 'ms')
+
+    @staticmethod
+    def to_datetimes(timestamps):
+        # convert a series of server timestamps to UTC datetimes
+        return pd.to_datetime(pd.Series(timestamps).astype(np.int64), unit='ms', utc=True)
+
+    @staticmethod
+    def to_dates(timestamps):
+        # convert a series of server timestamps to UTC date-like datetimes
+        return Market.to_datetimes(timestamps).dt.floor('D')
 
 
@@ -0,0 +1,172 @@
+from urllib.parse import urlparse
+from django.conf import settings
+import binance
+import redis
+import asyncio
+import threading
+import time
+
+
+RATE_LIMIT_URL = getattr(settings, 'CELERY_BROKER_URL', None)
+# weight budgets per minute of the Binance REST APIs along with the header reporting the used weight,
+# budgets are kept below the Binance limits to leave room for the requests in flight
+API_LIMITS = {
+    'api': (getattr(settings, 'BINANCE_API_WEIGHT', 1000), 'x-mbx-used-weight-1m'),
+    'sapi': (getattr(settings, 'BINANCE_SAPI_WEIGHT', 10000), 'x-sapi-used-ip-weight-1m'),
+}
+# weights of the heaviest endpoints we use, every other request weighs 1
+REQUEST_WEIGHTS = {
+    '/api/v3/ticker/24hr': 40,
+    '/api/v3/exchangeInfo': 10,
+    '/api/v3/account': 10,
+    '/api/v3/myTrades': 10,
+    '/sapi/v1/accountSnapshot': 2400,
+}
+WINDOW = 60 # Binance counts the weights per minute
+
+
+class RateLimiter:
+    '''Weight budget of a Binance REST API, refilled every minute like the Binance counters.
+       The budget is kept in Redis so that every worker and the web server draw from the same one,
+       it falls back to a process level budget when Redis is not available.'''
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    # raise the window counter to the weight reported by Binance, never lower it
+    _sync_script = '''
+        local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+        if tonumber(ARGV[1]) > used then
+            redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+        end
+    '''
+
+    def __init__(self, name, limit, header, url=RATE_LIMIT_URL):
+        self.name = name
+        self.limit = limit
+        self.header = header
+        self.redis = redis.Redis.from_url(url) if url else None
+        self.sync_script = self.redis.register_script(self._sync_script) if self.redis else None
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.paused_until = 0.0
+
+    @classmethod
+    def shared(cls, name):
+        '''Return the rate limiter of the API name shared by the whole process'''
+        with cls._shared_lock:
+            if name not in cls._shared:
+                limit, header = API_LIMITS[name]
+                cls._shared[name] = cls(name, limit, header)
+        return cls._shared[name]
+
+    def acquire(self, weight=1):
+        '''Block until weight can be spent in the current window'''
+        weight = min(weight, self.limit)
+        while True:
+            pause = self.get_pause()
+            if pause > 0:
+                time.sleep(pause)
+                continue
+            now = time.time()
+            window = int(now // WINDOW)
+            if self.spend(window, weight) <= self.limit:
+                return
+            # budget exhausted, wait for the next window
+            time.sleep((window + 1) * WINDOW - now)
+
+    def update(self, headers):
+        '''Synchronize the budget with the weight Binance reports in the response headers'''
+        retry_after = headers.get('Retry-After')
+        if retry_after:
+            self.pause(int(retry_after))
+        used = headers.get(self.header)
+        if used:
+            self.sync(int(time.time() // WINDOW), int(used))
+
+    def key(self, window):
+        return f'binance-weight:{self.name}:{window}'
+
+    def spend(self, window, weight):
+        '''Add weight to the window counter and return the weight used in the window'''
+        if self.redis:
+            try:
+                pipe = self.redis.pipeline()
+                pipe.incrby(self.key(window), weight)
+                pipe.expire(self.key(window), 2 * WINDOW)
+                return pipe.execute()[0]
+            except redis.RedisError as e:
+                print(f'Shared {self.name} weight budget unavailable, using the local one.\nRoot error: {e}')
+        with self.lock:
+            self.windows = {w: used for w, used in self.windows.items() if w >= window}
+            self.windows[window] = self.windows.get(window, 0) + weight
+            return self.windows[window]
+
+    def sync(self, window, used):
+        if self.redis:
+            try:
+                self.sync_script(keys=[self.key(window)], args=[used, 2 * WINDOW])
+                return
+            except redis.RedisError as e:
+                print(f'Shared {self.name} weight budget unavailable, using the local one.\nRoot error: {e}')
+        with self.lock:
+            self.windows[window] = max(self.windows.get(window, 0), used)
+
+    def pause(self, seconds):
+        '''Stop every request for seconds, after Binance asked to back off'''
+        if self.redis:
+            try:
+                self.redis.set(f'binance-pause:{self.name}', 1, ex=seconds)
+                return
+            except redis.RedisError as e:
+                print(f'Shared {self.name} weight budget unavailable, using the local one.\nRoot error: {e}')
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def get_pause(self):
+        '''Return the number of seconds left before requests can be sent again'''
+        if self.redis:
+            try:
+                return max(self.redis.pttl(f'binance-pause:{self.name}'), 0) / 1000
+            except redis.RedisError as e:
+                print(f'Shared {self.name} weight budget unavailable, using the local one.\nRoot error: {e}')
+        return max(self.paused_until - time.time(), 0.0)
+
+
+def get_limiter(uri):
+    '''Return the rate limiter of the API of uri along with the weight of the request'''
+    path = urlparse(uri).path
+    limiter = RateLimiter.shared('sapi' if path.startswith('/sapi/') else 'api')
+    return limiter, REQUEST_WEIGHTS.get(path, 1)
+
+
+class Client(binance.Client):
+    '''Binance REST client drawing the weight of every request from the shared budgets.
+       The budgets are synchronized from the response of each request, as the client may be
+       shared by several threads.'''
+
+    def _request(self, method, uri, signed, force_params=False, **kwargs):
+        limiter, weight = get_limiter(uri)
+        limiter.acquire(weight)
+        return super()._request(method, uri, signed, force_params, **kwargs)
+
+    def _handle_response(self, response):
+        limiter, _ = get_limiter(str(response.url))
+        limiter.update(response.headers)
+        return super()._handle_response(response)
+
+
+class AsyncClient(binance.AsyncClient):
+    '''Asynchronous Binance REST client drawing the weight of every request from the shared budgets.
+       Waiting for the budget happens in a thread so that other requests go on meanwhile.'''
+
+    async def _request(self, method, uri, signed, force_params=False, **kwargs):
+        limiter, weight = get_limiter(uri)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, limiter.acquire, weight)
+        return await super()._request(method, uri, signed, force_params, **kwargs)
+
+    async def _handle_response(self, response):
+        limiter, _ = get_limiter(str(response.url))
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, limiter.update, response.headers)
+        return await super()._handle_response(response)
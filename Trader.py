@@ -1,37 +1,75 @@
 import numpy as np
 import pandas as pd
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Case, When, Value, Sum, FloatField, OuterRef, Subquery, Window, RowRange
+from django.db.models.functions import Trunc, Cast, Coalesce, NullIf, Greatest, Ln, Exp, FirstValue, LastValue
 from Market import Market
-from TradingClient import TradingClient
+from TradingClient import TradingClient, BaseTradingClient
 from traderboard.models import (TradingAccount,
                                 SnapshotAccount, 
-                                SnapshotAccountDetails, 
                                 AccountTrades, 
-                                AccountTransactions)
+                                AccountTransactions,
+                                AccountPositions)
 
 
+# database truncation of the supported aggregation frequencies
+TRUNC_KINDS = {'H': 'hour', 'D': 'day'}
+# computed profiles are served from cache until new account data is recorded,
+# live balances are refreshed at the pace of the shared market prices
+PROFILE_TTL = getattr(settings, 'PROFILE_TTL', 5 * 60)
+
 
 class Trader(object):
     '''Class for every user-level aggregated functions that could be designed.'''
-    def __init__(self, user, markets=None):
+    def __init__(self, user, markets=None, offline=False):
+        '''Markets and balances are only requested to the exchanges when first needed.
+           An offline Trader never connects: it reads them from the last records in local database.'''
         self.user = user
+        self.offline = offline
         self.tas = TradingAccount.objects.filter(user=user)
-        self.markets = self.load_markets(markets)
-        self.tcs = [(TradingClient.connect(ta), self.markets[ta.platform]) for ta in self.tas]
+        self._markets = markets
+        self._balances = None
+        self.clients = [TradingClient.connect(ta, offline=True) for ta in self.tas]
+
+    @property
+    def markets(self):
+        if not self._markets:
+            self._markets = self.load_markets(None, self.offline)
+        return self._markets
 
-    def load_markets(self, markets):
+    @property
+    def tcs(self):
+        return [(tc, self.markets[tc.ta.platform]) for tc in self.clients]
+
+    def load_markets(self, markets, offline=False):
         if markets:
             return markets
         else:
             mkt = {}
             for ta in self.tas:
                 if ta.platform not in mkt.keys():
-                    mkt[ta.platform] = Market.connect(ta.platform)
+                    mkt[ta.platform] = Market.shared(ta.platform, offline)
             return mkt
 
+    def get_account_balances(self):
+        '''Fetch the balances of every account concurrently, along with their client and market.
+           Balances are fetched once per Trader, later calls reuse them.'''
+        if self._balances is None:
+            if self.offline:
+                balances = [tc.get_last_balances() for tc in self.clients]
+            else:
+                balances = TradingClient.get_all_balances(self.tas)
+            for tc_bal in balances:
+                if isinstance(tc_bal, Exception):
+                    raise tc_bal
+            self._balances = balances
+        return [(tc, market, tc_bal.copy()) for (tc, market), tc_bal in zip(self.tcs, self._balances)]
+
     def get_balances(self):
         balances = {}
-        for tc, _ in self.tcs:
-            tc_bal = tc.get_balances()
+        for _, _, tc_bal in self.get_account_balances():
             tc_bal = {asset: amount for asset, amount in zip(tc_bal['asset'], tc_bal['amount'])}
             for asset, amount in tc_bal.items():
                 if asset in balances.keys():
@@ -44,8 +82,7 @@ class Trader(object):
     def get_relative_balances(self, base='USDT'):
         total = 0.0
         balances = {}
-        for tc, market in self.tcs:
-            tc_bal = tc.get_balances()
+        for tc, market, tc_bal in self.get_account_balances():
             if not tc_bal.empty:
                 value_table = tc.get_value_table(tc_bal, market, base)
                 total += sum(value_table['value'])
@@ -61,7 +98,7 @@ class Trader(object):
         return balances
 
     def get_balances_value(self, base='USDT'):
-        return sum(tc.get_balances_value(market, base) for tc, market in self.tcs)
+        return sum(tc.get_value(tc_bal, market, base) for tc, market, tc_bal in self.get_account_balances())
 
     def get_deposits_value(self, date_from, date_to, base='USDT'):
         return sum(tc.get_deposits_value(date_from, date_to, market, base) for tc, market in self.tcs)
@@ -70,54 +107,126 @@ class Trader(object):
         return sum(tc.get_withdrawals_value(date_from, date_to, market, base) for tc, market in self.tcs)
 
     def get_snapshot_history(self, date_from, date_to, base='USDT'):
-        snaps = pd.DataFrame(columns=['created_at', 'pnl', 'balance'])
-        for tc, _ in self.tcs:
-            tc_snaps = tc.get_snapshot_history(date_from, date_to, base)
-            snaps = snaps.append(tc_snaps)
-        snaps = snaps.sort_values('created_at')
-        if len(snaps) > 0:
-            snaps.loc[0, 'pnl'] = 0 # first record becomes the reference
+        '''Return the snapshots of every account of the trader, tagged by account'''
+        suffix = 'btc' if base == 'BTC' else 'usdt'
+        snaps = SnapshotAccount.objects.filter(account__in=self.tas)\
+                                       .filter(created_at__range=[date_from, date_to])\
+                                       .order_by('created_at', 'id')\
+                                       .values('account', 'created_at', f'pnl_{suffix}', f'balance_{suffix}')
+        snaps = pd.DataFrame.from_records(snaps)
+        if snaps.empty:
+            snaps = pd.DataFrame(columns=['account', 'created_at', 'pnl', 'balance'])
+        else:
+            snaps = snaps.rename(columns={f'pnl_{suffix}': 'pnl', f'balance_{suffix}': 'balance'})
+            snaps = snaps.astype({'pnl': float, 'balance': float})
+            # first record of each account becomes the reference
+            snaps.loc[~snaps['account'].duplicated(), 'pnl'] = 0
         return snaps
 
     def get_stats(self, date_from, date_to, base='USDT'):
         snaps = self.get_snapshot_history(date_from, date_to, base)
         if not snaps.empty:
-            snaps['balance_open'] = snaps['balance'].shift(1)
+            snaps['balance_open'] = snaps.groupby('account')['balance'].shift(1)
             snaps['dep_wit'] = snaps['balance'] - snaps['balance_open'] - snaps['pnl']
+            pnl_rel = BaseTradingClient.get_relative_pnl(snaps['balance'], snaps['balance_open'], snaps['pnl'])
 
-            snaps.loc[snaps['dep_wit'] <= 0, 'pnl_rel'] = snaps.loc[snaps['dep_wit'] <= 0, 'pnl'] / \
-                snaps.loc[snaps['dep_wit'] <= 0, 'balance_open']
-
-            snaps.loc[snaps['dep_wit'] > 0, 'pnl_rel'] = snaps.loc[snaps['dep_wit'] > 0, 'pnl'] / \
-                (snaps.loc[snaps['dep_wit'] > 0, 'balance'] - snaps.loc[snaps['dep_wit'] > 0, 'pnl'])
-            
-            snaps['pnl_rel'] = snaps['pnl_rel'].replace([np.inf, -np.inf, np.nan], 0.0)
-            snaps['pnl_rel'] = 1.0 + snaps['pnl_rel']
+            snaps['pnl_rel'] = 1.0 + pnl_rel
             snaps['cum_pnl'] = snaps['pnl'].cumsum()
-            snaps['cum_pnl_rel'] = np.around(100 * (snaps['pnl_rel'].cumprod() - 1.0), 2)
+            snaps['cum_pnl_rel'] = np.around(100 * (np.cumprod(1.0 + pnl_rel) - 1.0), 2)
 
         else:
-            snaps = pd.DataFrame(columns=['created_at', 'pnl', 'balance', 'balance_open', 
+            snaps = pd.DataFrame(columns=['account', 'created_at', 'pnl', 'balance', 'balance_open', 
                                           'dep_wit', 'pnl_rel', 'cum_pnl', 'cum_pnl_rel'])
         return snaps
 
+    def get_window_return(self, date_from, date_to, base='USDT'):
+        '''Return the dates of the first and last snapshots taken between date_from and date_to,
+           along with the cumulative return (in %) in between. The return is read from the
+           return index of the first and last snapshots of each account, without loading the window.
+           An account wiped out in the window loses 100%, the stats are computed when the indexes
+           cannot tell the return.'''
+        suffix = 'btc' if base == 'BTC' else 'usdt'
+        window = SnapshotAccount.objects.filter(account=OuterRef('pk'))\
+                                        .filter(created_at__range=[date_from, date_to])
+        first = window.order_by('created_at', 'id')
+        last = window.order_by('-created_at', '-id')
+        wiped = window.filter(**{f'return_index_{suffix}': 0}).order_by('-created_at', '-id')
+        bounds = self.tas.annotate(first_at=Subquery(first.values('created_at')[:1]),
+                                   first_index=Subquery(first.values(f'return_index_{suffix}')[:1]),
+                                   last_at=Subquery(last.values('created_at')[:1]),
+                                   last_index=Subquery(last.values(f'return_index_{suffix}')[:1]),
+                                   wiped_at=Subquery(wiped.values('created_at')[:1]))\
+                         .filter(first_at__isnull=False)\
+                         .values('first_at', 'first_index', 'last_at', 'last_index', 'wiped_at')
+        bounds = pd.DataFrame.from_records(bounds)
+        if bounds.empty:
+            return None
+
+        # a chain restarts after a wiped out snapshot, the window then starts from 1
+        first_index = bounds['first_index'].astype(float).replace(0.0, 1.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = (bounds['last_index'].astype(float) / first_index).to_numpy()
+        ratios[(bounds['wiped_at'] > bounds['first_at']).to_numpy()] = 0.0
+        ratios[(bounds['last_at'] == bounds['first_at']).to_numpy()] = 1.0
+        if not np.isfinite(ratios).all():
+            stats = self.get_stats(date_from, date_to, base)
+            return stats['created_at'].min(), stats['created_at'].max(), stats['cum_pnl_rel'].iloc[-1]
+        cum_pnl_rel = round(100 * (ratios.prod() - 1.0), 2)
+        return bounds['first_at'].min(), bounds['last_at'].max(), cum_pnl_rel
+
     def get_aggregated_stats(self, date_from, date_to, freq, base='USDT'):
-        '''Aggregate stats by freq, day: D, hour: H,
-           see: https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases
+        '''Aggregate stats by freq, day: D, hour: H.
+           Stats are aggregated by the database, only one row per period is loaded.
         '''
-        stats = self.get_stats(date_from, date_to, base)
+        suffix = 'btc' if base == 'BTC' else 'usdt'
+        snaps = SnapshotAccount.objects.filter(account__in=self.tas)\
+                                       .filter(created_at__range=[date_from, date_to])
+        # balance of the previous snapshot of the account, the first one becomes the reference
+        previous = SnapshotAccount.objects.filter(account=OuterRef('account'))\
+                                          .filter(created_at__gte=date_from, created_at__lt=OuterRef('created_at'))\
+                                          .order_by('-created_at')\
+                                          .values(f'balance_{suffix}')[:1]
+        snaps = snaps.annotate(period=Trunc('created_at', TRUNC_KINDS[freq]),
+                               balance=Cast(f'balance_{suffix}', FloatField()),
+                               balance_open=Cast(Subquery(previous), FloatField()))
+        snaps = snaps.annotate(pnl=Case(When(balance_open__isnull=True, then=Value(0.0)),
+                                        default=Coalesce(Cast(f'pnl_{suffix}', FloatField()), Value(0.0)),
+                                        output_field=FloatField()))
+        snaps = snaps.annotate(dep_wit=F('balance') - F('balance_open') - F('pnl'))
+        snaps = snaps.annotate(pnl_rel=Value(1.0) + Coalesce(
+                                Case(When(dep_wit__gt=0, then=F('pnl') / NullIf(F('balance') - F('pnl'), Value(0.0))),
+                                     default=F('pnl') / NullIf(F('balance_open'), Value(0.0)),
+                                     output_field=FloatField()),
+                                Value(0.0)))
+
+        # aggregate each period over a window, then keep one row per period
+        window = {'partition_by': [F('period')], 
+                  'order_by': [F('created_at').asc(), F('id').asc()],
+                  'frame': RowRange(None, None)}
+        stats = snaps.annotate(period_pnl=Window(Sum('pnl'), **window),
+                               period_pnl_rel=Exp(Window(Sum(Ln(Greatest('pnl_rel', Value(1e-12)))), **window)),
+                               period_balance=Window(LastValue('balance'), **window),
+                               period_balance_open=Coalesce(Window(FirstValue('balance_open'), **window),
+                                                            Window(FirstValue('balance'), **window)))\
+                     .values('period', 'period_pnl', 'period_pnl_rel', 'period_balance', 'period_balance_open')\
+                     .distinct()\
+                     .order_by('period')
+        stats = pd.DataFrame.from_records(stats)
+
         if not stats.empty:
-            stats = stats.groupby(pd.Grouper(key='created_at', freq=freq))\
-                         .agg({'pnl': 'sum',
-                               'pnl_rel': 'prod',
-                               'balance': 'last',
-                               'balance_open': 'first',
-                            })\
-                        .reset_index()\
-                        .sort_values('created_at')
-            
+            stats = stats.rename(columns={'period': 'created_at',
+                                          'period_pnl': 'pnl',
+                                          'period_pnl_rel': 'pnl_rel',
+                                          'period_balance': 'balance',
+                                          'period_balance_open': 'balance_open'})
+            # periods without snapshot
+            stats = stats.set_index('created_at').asfreq(freq).reset_index()
+            stats['pnl'] = stats['pnl'].fillna(0.0)
+            stats['pnl_rel'] = stats['pnl_rel'].fillna(1.0)
+
             stats['cum_pnl'] = stats['pnl'].cumsum()
             stats['cum_pnl_rel'] = np.around(100 * (stats['pnl_rel'].cumprod() - 1), 2)
+            stats = stats[['created_at', 'pnl', 'pnl_rel', 'balance', 'balance_open', 'cum_pnl', 'cum_pnl_rel']]
         else:
             stats = pd.DataFrame(columns=['created_at', 'pnl', 'balance', 'balance_open', 
                                           'pnl_rel', 'cum_pnl', 'cum_pnl_rel'])
@@ -128,7 +237,7 @@ class Trader(object):
         # hard coded to binance market
         binance_market = self.markets['Binance']
         btc_stats = binance_market.get_price_history('BTC', base, date_from, date_to, freq)
-        btc_stats['created_at'] = btc_stats['open_time'].apply(Market.to_datetime)
+        btc_stats['created_at'] = Market.to_datetimes(btc_stats['open_time'])
         btc_stats['pnl'] = btc_stats['close_price'] - btc_stats['open_price']
         btc_stats['pnl_rel'] = btc_stats['pnl'] / btc_stats['open_price']
         btc_stats['cum_pnl'] = btc_stats['pnl'].cumsum()
@@ -136,63 +245,93 @@ class Trader(object):
         return btc_stats
 
     def get_transaction_history(self, date_from, date_to):
-        trans = pd.DataFrame(columns=['created_at', 'asset', 'amount', 'side'])
-        for tc, _ in self.tcs:
-            tc_trans = tc.get_transaction_history(date_from, date_to)
-            trans = trans.append(tc_trans)
-        trans = trans.sort_values('created_at', ascending=False)
+        '''Return the transactions of every account of the trader, tagged by account, latest first'''
+        trans = AccountTransactions.objects.filter(account__in=self.tas)\
+                                           .filter(created_at__range=[date_from, date_to])\
+                                           .order_by('-created_at')\
+                                           .values('account', 'created_at', 'asset', 'amount', 'side')
+        trans = pd.DataFrame.from_records(trans)
+        if trans.empty:
+            trans = pd.DataFrame(columns=['account', 'created_at', 'asset', 'amount', 'side'])
         return trans
 
     def get_trade_history(self, date_from, date_to):
-        trades = pd.DataFrame(columns=['created_at', 'symbol', 'amount', 'price', 'side'])
-        for tc, _ in self.tcs:
-            tc_trades = tc.get_trade_history(date_from, date_to)
-            trades = trades.append(tc_trades)
-        trades = trades.sort_values('created_at', ascending=False)
+        '''Return the trades of every account of the trader, tagged by account, latest first'''
+        trades = AccountTrades.objects.filter(account__in=self.tas)\
+                                      .filter(created_at__range=[date_from, date_to])\
+                                      .order_by('-created_at')\
+                                      .values('account', 'created_at', 'symbol', 'amount', 'price', 'side')
+        trades = pd.DataFrame.from_records(trades)
+        if trades.empty:
+            trades = pd.DataFrame(columns=['account', 'created_at', 'symbol', 'amount', 'price', 'side'])
         return trades
 
     def get_balances_performance(self, assets, base='USDT'):
         # hard coded to binance market
         binance_market = self.markets['Binance']
-        perfs = pd.DataFrame(columns=['asset', 'perf_last_24h', 'perf_last_buy'])
-        for asset in assets:
-            asset_perfs = {'asset': asset}
-            prices = binance_market.get_price(asset, base)
-            try:
-                asset_perfs['perf_last_24h'] = \
-                                round(100*(prices['lastPrice'] - prices['openPrice']) / prices['openPrice'], 2)
-            except ZeroDivisionError:
-                asset_perfs['perf_last_24h'] = None
-                
+        suffix = 'btc' if base == 'BTC' else 'usdt'
+        perfs = binance_market.get_prices(assets, base)[['asset', 'lastPrice', 'openPrice']]
+
+        # last buy of each asset among every account
+        positions = AccountPositions.objects.filter(account__in=self.tas)\
+                                            .filter(asset__in=perfs['asset'].tolist())\
+                                            .order_by('last_buy_at')\
+                                            .values_list('asset', f'last_buy_price_{suffix}')
+        buy_prices = {asset: float(price) for asset, price in positions if price is not None}
+        buy_price = perfs['asset'].map(buy_prices).astype(float).to_numpy()
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            perf_last_24h = np.around(100 * (perfs['lastPrice'] - perfs['openPrice']) / perfs['openPrice'], 2)
+            perf_last_buy = np.around(100 * (perfs['lastPrice'] - buy_price) / buy_price, 2)
+        # missing prices are reported as None
+        perfs['perf_last_24h'] = perf_last_24h.astype(object).where(np.isfinite(perf_last_24h), None)
+        perfs['perf_last_buy'] = perf_last_buy.astype(object).where(np.isfinite(perf_last_buy), None)
+        return perfs[['asset', 'perf_last_24h', 'perf_last_buy']]
+
+
+    @staticmethod
+    def get_profile_version(user_id):
+        '''Return the version of the cached profiles of user, it changes whenever new data is recorded'''
+        key = f'profile-version:{user_id}'
+        try:
+            version = cache.get(key)
+            if version is None:
+                cache.add(key, time.time_ns(), None)
+                version = cache.get(key)
+            return version
+        except Exception as e:
+            print(f'Profile cache unavailable.\nRoot error: {e}')
+            return None
+
+    @staticmethod
+    def expire_profiles(user_id):
+        '''Invalidate every cached profile of user'''
+        try:
+            cache.set(f'profile-version:{user_id}', time.time_ns(), None)
+        except Exception as e:
+            print(f'Profile cache unavailable.\nRoot error: {e}')
+
+    def get_cached_profile(self, date_from, date_to, base='USDT', overview=True):
+        '''Return the profile of get_profile, computed once per version of the user data.
+           The user is not cached, it is always the current one.'''
+        version = self.get_profile_version(self.user.id)
+        if version is None:
+            return self.get_profile(date_from, date_to, base, overview)
+
+        key = f'profile:{self.user.id}:{version}:{date_from.isoformat()}:{date_to.isoformat()}:{base}:{int(overview)}'
+        try:
+            profile = cache.get(key)
+        except Exception as e:
+            print(f'Profile cache unavailable.\nRoot error: {e}')
+            profile = None
+        if profile is None:
+            profile = self.get_profile(date_from, date_to, base, overview)
             try:
-                last_buy = AccountTrades.objects.filter(account__in=self.tas)\
-                                                .filter(symbol__startswith=asset)\
-                                                .filter(side='BUY')\
-                                                .latest('created_at')
-                if last_buy.symbol.endswith(base):
-                    buy_price = float(last_buy.price)
-                else:
-                    # TODO:
-                    # The most scalable thing is to have a Market table containing the price
-                    # of each coin at each hour (cronjob for price extraction)
-                    # rather to store the price of each asset possessed by a ta in SnapshotDetails
-                    snap = SnapshotAccount.objects.filter(account=last_buy.account)\
-                                                .filter(created_at__gte=last_buy.created_at)\
-                                                .earliest('created_at')
-                    snap_detail = SnapshotAccountDetails.objects.filter(snapshot=snap)\
-                                                                .get(asset=asset)
-                    if base == 'BTC':
-                        buy_price = float(snap_detail.price_btc)
-                    else:
-                        buy_price = float(snap_detail.price_usdt)
-
-                asset_perfs['perf_last_buy'] = round(100*(prices['lastPrice'] - buy_price) / buy_price, 2)
-            except:
-                asset_perfs['perf_last_buy'] = None
-
-            perfs = perfs.append(asset_perfs, ignore_index=True)
-        return perfs
-
+                cache.set(key, {k: v for k, v in profile.items() if k != 'trader'}, PROFILE_TTL)
+            except Exception as e:
+                print(f'Profile of user {self.user.id} not cached.\nRoot error: {e}')
+        profile['trader'] = self.user
+        return profile
 
     def get_profile(self, date_from, date_to, base='USDT', overview=True):
         '''Process all metrics displayed in user's profile'''
@@ -208,8 +347,7 @@ class Trader(object):
                                            freq='1d', 
                                            base=base)
             # get PnL aggregated history
-            cum_pnl_hist = {'labels': stats['created_at'].apply(
-                                        lambda x: x.to_pydatetime().strftime('%d %b')).tolist(),
+            cum_pnl_hist = {'labels': stats['created_at'].dt.strftime('%d %b').tolist(),
                             'data': stats['cum_pnl_rel'].tolist(),
                             'btc_data': btc_stats['cum_pnl_rel'].tolist()}
             profile['cum_pnl_hist'] = cum_pnl_hist
@@ -222,7 +360,7 @@ class Trader(object):
 
         # get trade history
         trades_hist = self.get_trade_history(date_from, date_to)
-        trades_hist['time'] = trades_hist['created_at'].apply(lambda x: x.to_pydatetime().strftime('%d %b %Y %H:%M:%S (UTC)'))
+        trades_hist['time'] = pd.to_datetime(trades_hist['created_at'], utc=True).dt.strftime('%d %b %Y %H:%M:%S (UTC)')
         trades_hist['amount'] = trades_hist['amount'].apply(lambda x: x.normalize())
         trades_hist['price'] = trades_hist['price'].apply(lambda x: x.normalize())
         profile['trades_hist'] = trades_hist.to_dict('records')
@@ -238,14 +376,12 @@ class Trader(object):
         if not overview:
             if not stats.empty:
                 # get balance aggregated history
-                balance_hist = {'labels': stats['created_at'].apply(
-                                            lambda x: x.to_pydatetime().strftime('%d %b')).tolist(),
+                balance_hist = {'labels': stats['created_at'].dt.strftime('%d %b').tolist(),
                                 'data': stats['balance'].tolist()}
                 profile['balance_hist'] = balance_hist
 
                 # get daily pnl
-                daily_pnl_hist = {'labels': stats['created_at'].apply(
-                                                lambda x: x.to_pydatetime().strftime('%d %b')).tolist(),
+                daily_pnl_hist = {'labels': stats['created_at'].dt.strftime('%d %b').tolist(),
                                 'data': stats['pnl'].tolist()}
                 profile['daily_pnl_hist'] = daily_pnl_hist
 
@@ -255,7 +391,7 @@ class Trader(object):
 
             # get transaction history
             trans_hist = self.get_transaction_history(date_from, date_to)
-            trans_hist['time'] = trans_hist['created_at'].apply(lambda x: x.to_pydatetime().strftime('%d %b %Y %H:%M:%S (UTC)'))
+            trans_hist['time'] = pd.to_datetime(trans_hist['created_at'], utc=True).dt.strftime('%d %b %Y %H:%M:%S (UTC)')
             trans_hist['amount'] = trans_hist['amount'].apply(lambda x: x.normalize())
             profile['trans_hist'] = trans_hist.to_dict('records')
 
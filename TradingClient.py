@@ -1,21 +1,24 @@
 from multipledispatch import dispatch
+import asyncio
 import time
 import pandas as pd
 import numpy as np
 from decimal import Decimal
 from datetime import date, datetime, timedelta, timezone
-from binance import Client
+from RateLimiter import Client, AsyncClient
 from Market import BinanceMarket, Market
 from django.db.models import Max, Sum, Min
 from django.db.models.functions import Trunc
-from django.db import IntegrityError
-from traderboard.models import (SnapshotAccount, 
+from django.db import transaction
+from traderboard.models import (TradingAccount,
+                                SnapshotAccount, 
                                 SnapshotAccountDetails, 
                                 AccountTrades, 
                                 AccountTransactions)
 
 
 __PLATFORMS__ = ['Binance']
+CLIENT_CONCURRENCY = 20 # accounts requested at the same time
 
 
 class BaseTradingClient:
@@ -47,6 +50,17 @@ class BaseTradingClient:
             snaps = snaps[['created_at', 'pnl', 'balance']]
         return snaps
 
+    def get_last_balances(self):
+        '''Return the balances recorded by the last snapshot'''
+        last_snap = SnapshotAccount.objects.filter(account=self.ta).order_by('-created_at').first()
+        details = SnapshotAccountDetails.objects.filter(snapshot=last_snap).values('asset', 'amount')
+        balances = pd.DataFrame.from_records(details)
+        if balances.empty:
+            balances = pd.DataFrame(columns=['asset', 'amount'])
+        else:
+            balances['amount'] = balances['amount'].astype(float)
+        return balances
+
     def get_transaction_history(self, date_from, date_to):
         trans = AccountTransactions.objects.filter(account=self.ta)\
                                            .filter(created_at__range=[date_from, date_to])\
@@ -61,6 +75,60 @@ class BaseTradingClient:
             trans_hist = trans_hist[['created_at', 'asset', 'amount', 'side']]
         return trans_hist
 
+    def get_transaction_sums(self, date_from, date_to, side=None):
+        '''Return the amount transferred per asset and side between date_from and date_to'''
+        trans = AccountTransactions.objects.filter(account=self.ta)\
+                                           .filter(created_at__range=[date_from, date_to])
+        if side:
+            trans = trans.filter(side=side)
+        sums = trans.values('asset', 'side').annotate(amount=Sum('amount')).order_by()
+        sums = pd.DataFrame.from_records(sums)
+        if sums.empty:
+            sums = pd.DataFrame(columns=['asset', 'side', 'amount'])
+        else:
+            sums['amount'] = sums['amount'].astype(float)
+            sums = sums[['asset', 'side', 'amount']]
+        return sums
+
+    @staticmethod
+    def get_relative_pnl(balance, balance_open, pnl):
+        '''Return the PnL relative to the opening balance, or to the closing one minus the PnL after a deposit.
+           Undefined returns, like the one of a first snapshot, are 0.'''
+        balance, balance_open, pnl = (np.asarray(x, dtype=float) for x in (balance, balance_open, pnl))
+        dep_wit = balance - balance_open - pnl
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pnl_rel = np.where(dep_wit > 0, pnl / (balance - pnl), pnl / balance_open)
+        pnl_rel[~np.isfinite(pnl_rel)] = 0.0
+        return pnl_rel
+
+    def update_return_index(self, date_from=None):
+        '''Chain the return index of the snapshots taken from date_from, every snapshot by default'''
+        snaps = SnapshotAccount.objects.filter(account=self.ta).order_by('created_at', 'id')
+        previous = None
+        if date_from:
+            previous = snaps.filter(created_at__lt=date_from).last()
+            if previous is not None and previous.return_index_usdt is None:
+                return self.update_return_index()
+            snaps = snaps.filter(created_at__gte=date_from)
+        snaps = list(snaps)
+        if not snaps:
+            return 0
+
+        to_float = lambda x: np.nan if x is None else float(x)
+        for suffix in ['btc', 'usdt']:
+            balance = np.array([to_float(getattr(snap, f'balance_{suffix}')) for snap in snaps])
+            pnl = np.array([to_float(getattr(snap, f'pnl_{suffix}')) for snap in snaps])
+            balance_open = np.roll(balance, 1)
+            balance_open[0] = np.nan if previous is None else to_float(getattr(previous, f'balance_{suffix}'))
+            factors = 1.0 + self.get_relative_pnl(balance, balance_open, pnl)
+            index = None if previous is None else getattr(previous, f'return_index_{suffix}')
+            for snap, factor in zip(snaps, factors):
+                # the index of a wiped out account stays 0, a new chain starts from the next snapshot
+                index = (index or 1.0) * float(factor)
+                setattr(snap, f'return_index_{suffix}', index)
+        SnapshotAccount.objects.bulk_update(snaps, ['return_index_btc', 'return_index_usdt'], batch_size=1000)
+        return len(snaps)
+
     def get_deposit_history(self, date_from, date_to):
         trans_hist = self.get_transaction_history(date_from, date_to)
         dep_hist = trans_hist[trans_hist['side'] == 'DEPOSIT']
@@ -106,6 +174,10 @@ class BinanceTradingClient(BaseTradingClient):
     def get_balances(self):
         '''Get current balances of SPOT account.'''
         info = self.client.get_account()
+        return self.parse_balances(info)
+
+    def parse_balances(self, info):
+        '''Return the non empty balances of the account info returned by the REST API'''
         balances = pd.DataFrame(info['balances'])
         balances['amount'] = balances['free'].astype(float) + balances['locked'].astype(float)
         balances = balances[balances['amount'] > 0.0]
@@ -113,8 +185,9 @@ class BinanceTradingClient(BaseTradingClient):
 
     def get_value_table(self, balances, market, base='USDT'):
         '''Compute the value of a balances using the current market prices.'''
+        balances = balances.copy()
         balances['base'] = base
-        balances['price'] = balances.apply(lambda x: market.get_price(x['asset'], x['base'])['lastPrice'], axis=1)
+        balances['price'] = market.get_prices(balances['asset'], base)['lastPrice'].to_numpy()
         balances['value'] = balances['amount'] * balances['price']
         return balances
 
@@ -133,19 +206,27 @@ class BinanceTradingClient(BaseTradingClient):
 
     def get_deposits_value(self, date_from, date_to, market, base='USDT'):
         '''To be used only when date_from and date_to are close'''
-        deposits = self.get_deposit_history(date_from, date_to)
+        deposits = self.get_transaction_sums(date_from, date_to, 'DEPOSIT')
         return self.get_value(deposits, market, base)
 
     def get_withdrawals_value(self, date_from, date_to, market, base='USDT'):
         '''To be used only when date_from and date_to are close'''
-        withdrawals = self.get_withdrawal_history(date_from, date_to)
+        withdrawals = self.get_transaction_sums(date_from, date_to, 'WITHDRAWAL')
         return self.get_value(withdrawals, market, base)
 
-    def get_pnl(self, snap, now, market, base='USDT'):
-        '''Compute PnL since snap until now. Only valid for small time intervals.'''
-        deposits = self.get_deposits_value(snap.created_at, now, market, base)
-        withdrawals = self.get_withdrawals_value(snap.created_at, now, market, base)
-        balance_now = self.get_balances_value(market, base)
+    def get_pnl(self, snap, now, market, base='USDT', balances=None):
+        '''Compute PnL since snap until now. Only valid for small time intervals.
+           Current balances are fetched unless provided.'''
+        transfers = self.get_transaction_sums(snap.created_at, now)
+        if transfers.empty:
+            deposits = withdrawals = 0.0
+        else:
+            transfers = self.get_value_table(transfers, market, base)
+            deposits = transfers.loc[transfers['side'] == 'DEPOSIT', 'value'].sum()
+            withdrawals = transfers.loc[transfers['side'] == 'WITHDRAWAL', 'value'].sum()
+        if balances is None:
+            balances = self.get_balances()
+        balance_now = self.get_value(balances, market, base)
 
         if base == 'USDT':
             balance_from = float(snap.balance_usdt)
@@ -169,7 +250,7 @@ class BinanceTradingClient(BaseTradingClient):
         if crypto_info:
             crypto_deposits = pd.DataFrame(crypto_info)
             crypto_deposits['time'] = crypto_deposits['insertTime'].astype(int)
-            crypto_deposits['created_at'] = crypto_deposits['time'].apply(lambda x: Market.to_datetime(x))
+            crypto_deposits['created_at'] = Market.to_datetimes(crypto_deposits['time'])
             crypto_deposits['amount'] = crypto_deposits['amount'].astype(float)
             crypto_deposits['asset'] = crypto_deposits['coin']
             crypto_deposits['side'] = 'DEPOSIT'
@@ -185,7 +266,7 @@ class BinanceTradingClient(BaseTradingClient):
             fiat_deposits = pd.DataFrame(fiat_info)
             fiat_deposits = fiat_deposits[fiat_deposits['status'] == 'Successful']
             fiat_deposits['time'] = fiat_deposits['createTime']
-            fiat_deposits['created_at'] = fiat_deposits['time'].apply(lambda x: Market.to_datetime(x))
+            fiat_deposits['created_at'] = Market.to_datetimes(fiat_deposits['time'])
             fiat_deposits['amount'] = fiat_deposits['amount'].astype(float)
             fiat_deposits['asset'] = fiat_deposits['fiatCurrency']
             fiat_deposits['side'] = 'DEPOSIT'
@@ -207,8 +288,8 @@ class BinanceTradingClient(BaseTradingClient):
         crypto_withdrawals = pd.DataFrame(columns=['created_at', 'time', 'asset', 'amount', 'side'])
         if crypto_info:
             crypto_withdrawals = pd.DataFrame(crypto_info)
-            crypto_withdrawals['time'] = crypto_withdrawals['applyTime'].apply(lambda x: Market.to_timestamp(x))
-            crypto_withdrawals['created_at'] = crypto_withdrawals['time'].apply(lambda x: Market.to_datetime(x))
+            crypto_withdrawals['time'] = Market.to_timestamps(crypto_withdrawals['applyTime'])
+            crypto_withdrawals['created_at'] = Market.to_datetimes(crypto_withdrawals['time'])
             crypto_withdrawals['amount'] = crypto_withdrawals['amount'].astype(float)
             crypto_withdrawals['asset'] = crypto_withdrawals['coin']
             crypto_withdrawals['side'] = 'WITHDRAWAL'
@@ -224,7 +305,7 @@ class BinanceTradingClient(BaseTradingClient):
             fiat_withdrawals = pd.DataFrame(fiat_info)
             fiat_withdrawals = fiat_withdrawals[fiat_withdrawals['status'] == 'Successful']
             fiat_withdrawals['time'] = fiat_withdrawals['createTime']
-            fiat_withdrawals['created_at'] = fiat_withdrawals['time'].apply(lambda x: Market.to_datetime(x))
+            fiat_withdrawals['created_at'] = Market.to_datetimes(fiat_withdrawals['time'])
             fiat_withdrawals['amount'] = fiat_withdrawals['amount'].astype(float)
             fiat_withdrawals['asset'] = fiat_withdrawals['fiatCurrency']
             fiat_withdrawals['side'] = 'WITHDRAWAL'
@@ -241,20 +322,28 @@ class BinanceTradingClient(BaseTradingClient):
         return trans_hist
 
     def load_transaction_history(self, date_from, date_to):
-        '''Load transactions between date_from and date_to in local database.'''
+        '''Load transactions between date_from and date_to in local database.
+           Return the number of transactions inserted and skipped (already recorded).'''
         trans_hist = self.get_api_transaction_history(date_from, date_to)
-        for _, item in trans_hist.iterrows():
-            trans = AccountTransactions(account=self.ta,
-                                        created_at=item['created_at'].to_pydatetime(),
-                                        updated_at=datetime.now(timezone.utc),
-                                        asset=item['asset'],
-                                        amount=item['amount'],
-                                        side=item['side']
-                                        )
-            try:
-                trans.save()
-            except IntegrityError as e:
-                print(e)
+        now = datetime.now(timezone.utc)
+        trans = [AccountTransactions(account=self.ta,
+                                     created_at=item.created_at.to_pydatetime(),
+                                     updated_at=now,
+                                     asset=item.asset,
+                                     amount=item.amount,
+                                     side=item.side
+                                     )
+                 for item in trans_hist.itertuples()]
+        # transactions are identified by their unique constraint, amounts as recorded with 10 decimals
+        key = lambda item: (item.created_at, item.asset, round(float(item.amount), 10), item.side)
+        keys = {key(item) for item in trans}
+        with transaction.atomic():
+            TradingAccount.objects.select_for_update().get(id=self.ta.id)
+            recorded = AccountTransactions.objects.filter(account=self.ta)\
+                                                  .filter(created_at__in={item.created_at for item in trans})
+            inserted = len(keys - {key(item) for item in recorded})
+            AccountTransactions.objects.bulk_create(trans, ignore_conflicts=True)
+        return {'transactions': (inserted, len(trans) - inserted)}
 
     def load_snapshot_history(self, date_from, date_to, market):
         '''Load snapshots between date_from and date_to in local database.'''
@@ -330,34 +419,82 @@ class BinanceTradingClient(BaseTradingClient):
                               - agg_stats['deposits_usdt'] + agg_stats['withdrawals_usdt']        
         agg_stats = agg_stats.dropna()
 
-        # record snaps in database
-        for stat in agg_stats.itertuples(name='Stat'):
-            snap = SnapshotAccount(account=self.ta,
-                                   balance_btc=Decimal(stat.close_balance_btc),
-                                   balance_usdt=Decimal(stat.close_balance_usdt),
-                                   pnl_btc=Decimal(stat.pnl_btc),
-                                   pnl_usdt=Decimal(stat.pnl_usdt),
-                                   created_at=Market.to_datetime(stat.close_time),
-                                   updated_at=datetime.now(timezone.utc)
-                                   )
-            try:
-                snap.save()
-                snap_details = snapshots[snapshots['close_time'] == stat.close_time]
-                snap_details = snap_details.merge(prices, on=['asset', 'close_time'])
-                for item in snap_details.itertuples(name='Snap'):
-                    detail = SnapshotAccountDetails(snapshot=snap, 
-                                                    asset=item.asset, 
-                                                    amount=Decimal(item.amount),
-                                                    price_usdt=Decimal(item.close_price_usdt),
-                                                    price_btc=Decimal(item.close_price_btc)
-                                                    )
-                    try:
-                        detail.save()
-                    except IntegrityError as e:
-                        print(e)
-
-            except IntegrityError as e: 
-                print(e)
+        # record snaps in database, along with their details, skipping the ones already recorded.
+        # Overlapping windows are loaded concurrently: the account lock serializes their inserts
+        # so that the keys looked up right before the insert are the ones actually missing.
+        agg_stats['created_at'] = Market.to_datetimes(agg_stats['close_time'])
+        now = datetime.now(timezone.utc)
+        with transaction.atomic():
+            TradingAccount.objects.select_for_update().get(id=self.ta.id)
+            recorded = SnapshotAccount.objects.filter(account=self.ta)\
+                                              .filter(created_at__in=[created_at.to_pydatetime() for created_at in agg_stats['created_at']])\
+                                              .values_list('created_at', flat=True)
+            new_stats = agg_stats[~agg_stats['created_at'].isin(pd.to_datetime(list(recorded), utc=True))]
+            snaps = [SnapshotAccount(account=self.ta,
+                                     balance_btc=Decimal(stat.close_balance_btc),
+                                     balance_usdt=Decimal(stat.close_balance_usdt),
+                                     pnl_btc=Decimal(stat.pnl_btc),
+                                     pnl_usdt=Decimal(stat.pnl_usdt),
+                                     created_at=stat.created_at.to_pydatetime(),
+                                     updated_at=now
+                                     )
+                     for stat in new_stats.itertuples(name='Stat')]
+            snap_details = snapshots.merge(prices, on=['asset', 'close_time'])\
+                                    .merge(new_stats[['close_time', 'created_at']], on='close_time')
+            SnapshotAccount.objects.bulk_create(snaps, ignore_conflicts=True)
+            snap_ids = SnapshotAccount.objects.filter(account=self.ta)\
+                                              .filter(created_at__in=[snap.created_at for snap in snaps])\
+                                              .values_list('created_at', 'id')
+            snap_ids = {pd.Timestamp(created_at): snap_id for created_at, snap_id in snap_ids}
+            details = [SnapshotAccountDetails(snapshot_id=snap_ids[item.created_at],
+                                              asset=item.asset, 
+                                              amount=Decimal(item.amount),
+                                              price_usdt=Decimal(item.close_price_usdt),
+                                              price_btc=Decimal(item.close_price_btc)
+                                              )
+                       for item in snap_details.itertuples(name='Snap')]
+            recorded_details = SnapshotAccountDetails.objects.filter(snapshot_id__in=snap_ids.values())\
+                                                             .values_list('snapshot_id', 'asset')
+            inserted_details = len({(item.snapshot_id, item.asset) for item in details} - set(recorded_details))
+            SnapshotAccountDetails.objects.bulk_create(details, ignore_conflicts=True)
+
+        return {'snapshots': (len(snaps), len(agg_stats) - len(snaps)),
+                'details': (inserted_details, len(details) - inserted_details)}
+
+
+class AsyncBinanceTradingClient(BinanceTradingClient):
+    '''Client for Binance trading account, requesting the REST API asynchronously.
+       Methods querying the local database are the synchronous ones of BinanceTradingClient.'''
+
+    @classmethod
+    async def connect(cls, ta, timestamp_offset=None):
+        '''Connect to the trading account. The handshake of AsyncClient.create (ping and server time)
+           is skipped when the offset to the server time is already known.'''
+        self = cls(ta)
+        if timestamp_offset is None:
+            self.client = await AsyncClient.create(self.api_key, self.api_secret)
+        else:
+            self.client = AsyncClient(self.api_key, self.api_secret)
+            self.client.timestamp_offset = timestamp_offset
+        return self
+
+    @staticmethod
+    async def get_timestamp_offset():
+        '''Return the offset (in ms) between the server time and the local one'''
+        client = AsyncClient()
+        try:
+            res = await client.get_server_time()
+            return res['serverTime'] - int(time.time() * 1000)
+        finally:
+            await client.close_connection()
+
+    async def close(self):
+        await self.client.close_connection()
+
+    async def get_balances(self):
+        '''Get current balances of SPOT account.'''
+        info = await self.client.get_account()
+        return self.parse_balances(info)
 
 
 class TradingClient:
@@ -365,11 +502,62 @@ class TradingClient:
         self._clients = {
             'Binance': BinanceTradingClient
         }
+        self._async_clients = {
+            'Binance': AsyncBinanceTradingClient
+        }
     
     @classmethod
-    def connect(cls, ta):
+    def connect(cls, ta, offline=False):
+        '''Connect to the trading account ta. An offline client does not connect to the platform,
+           it only serves the data stored in local database and values the balances it is given.'''
         self = cls()
         client = self._clients[ta.platform]
         if not client:
             raise ValueError(f'Platform not supported - {ta.platform}')
-        return client.connect(ta)
\ No newline at end of file
+        if offline:
+            return client(ta)
+        return client.connect(ta)
+
+    @classmethod
+    async def connect_async(cls, ta, timestamp_offset=None):
+        self = cls()
+        client = self._async_clients[ta.platform]
+        if not client:
+            raise ValueError(f'Platform not supported - {ta.platform}')
+        return await client.connect(ta, timestamp_offset)
+
+    @classmethod
+    async def get_timestamp_offsets(cls, platforms):
+        '''Return the offset to the server time of every platform, None when it could not be requested'''
+        self = cls()
+        offsets = {}
+        for platform in platforms:
+            try:
+                offsets[platform] = await self._async_clients[platform].get_timestamp_offset()
+            except Exception as e:
+                print(f'Server time of {platform} unavailable.\nRoot error: {e}')
+                offsets[platform] = None
+        return offsets
+
+    @classmethod
+    async def gather_balances(cls, tas):
+        '''Fetch the balances of the trading accounts of tas concurrently.
+           The server time is requested once per platform instead of once per account.'''
+        semaphore = asyncio.Semaphore(CLIENT_CONCURRENCY)
+        offsets = await cls.get_timestamp_offsets({ta.platform for ta in tas})
+
+        async def fetch(ta):
+            async with semaphore:
+                tc = await cls.connect_async(ta, offsets[ta.platform])
+                try:
+                    return await tc.get_balances()
+                finally:
+                    await tc.close()
+
+        return await asyncio.gather(*(fetch(ta) for ta in tas), return_exceptions=True)
+
+    @classmethod
+    def get_all_balances(cls, tas):
+        '''Fetch the balances of every trading account of tas concurrently. Balances are returned
+           in the order of tas, an account whose balances could not be fetched gets the exception raised.'''
+        return asyncio.run(cls.gather_balances(list(tas)))
\ No newline at end of file
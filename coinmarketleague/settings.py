@@ -185,8 +185,9 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_TIMEZONE = "UTC"
 
 CELERY_BEAT_SCHEDULE = {
-    "update_all_profile": {
-        "task": "traderboard.tasks.update_all_profile",
+    # records market prices then updates every profile
+    "update_all_market": {
+        "task": "traderboard.tasks.update_all_market",
         "schedule": crontab(minute=[0,]),
     },
 }
@@ -204,6 +205,19 @@ CACHES = {
 }
 # Cache time to live is 1 min
 CACHE_TTL = 1 * 60
+# Shared market prices are refreshed every 5 min
+MARKET_TTL = 5 * 60
+# Shared market prices follow the market streams in between refreshes
+MARKET_LIVE = int(os.environ.get("MARKET_LIVE", default=0))
+# Computed profiles are cached until new account data is recorded, 5 min at most
+PROFILE_TTL = 5 * 60
+# Exchange symbols are downloaded again once a day
+EXCHANGE_INFO_TTL = 24 * 60 * 60
+# Binance REST weight budgets per minute, shared by every worker (Binance limits: 1200 and 12000)
+BINANCE_API_WEIGHT = 1000
+BINANCE_SAPI_WEIGHT = 10000
+# Memory-mapped archive of the symbol prices, rebuilt from the klines when missing
+PRICE_ARCHIVE_DIR = os.environ.get("PRICE_ARCHIVE_DIR", os.path.join(BASE_DIR, "archive"))
 
 # ERD mdoel
 GRAPH_MODELS = {
@@ -2,7 +2,7 @@ from django.contrib.auth.models import User
 from traderboard.models import TradingAccount
 from Market import Market
 from datetime import datetime, timezone
-from traderboard.tasks import take_snapshot, update_profile
+from traderboard.tasks import take_snapshot, take_market_snapshot, update_profile
 
 
 __PLATFORMS__ = ['Binance']
@@ -12,6 +12,8 @@ def run():
     # Take time snapshot of market state
     now = datetime.now(timezone.utc)
     markets = {platform : Market.connect(platform) for platform in __PLATFORMS__}
+    for market in markets.values():
+        take_market_snapshot(market, now)
     users = User.objects.all()
 
     for user in users:
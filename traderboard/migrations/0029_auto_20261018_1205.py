@@ -0,0 +1,33 @@
+# Generated by Django 3.2.3 on 2026-10-18 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('traderboard', '0028_auto_20210924_0918'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarketKlines',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('platform', models.CharField(choices=[('Binance', 'Binance')], default='Binance', max_length=100)),
+                ('symbol', models.CharField(max_length=20)),
+                ('interval', models.CharField(max_length=3)),
+                ('open_time', models.BigIntegerField()),
+                ('close_time', models.BigIntegerField()),
+                ('open_price', models.FloatField()),
+                ('high_price', models.FloatField()),
+                ('low_price', models.FloatField()),
+                ('close_price', models.FloatField()),
+                ('volume', models.FloatField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='marketklines',
+            constraint=models.UniqueConstraint(fields=('platform', 'symbol', 'interval', 'open_time'), name='No kline duplicate'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.3 on 2026-10-18 12:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('traderboard', '0029_auto_20261018_1205'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshotmarket',
+            name='high_price',
+            field=models.DecimalField(decimal_places=10, default=None, max_digits=30, null=True),
+        ),
+        migrations.AddField(
+            model_name='snapshotmarket',
+            name='low_price',
+            field=models.DecimalField(decimal_places=10, default=None, max_digits=30, null=True),
+        ),
+        migrations.AddField(
+            model_name='snapshotmarket',
+            name='open_price',
+            field=models.DecimalField(decimal_places=10, default=None, max_digits=30, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='snapshotmarket',
+            index=models.Index(fields=['platform', 'created_at'], name='traderboard_platfor_97507a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='snapshotmarket',
+            index=models.Index(fields=['platform', 'symbol', 'created_at'], name='traderboard_platfor_c97f55_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.3 on 2026-10-18 12:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('traderboard', '0030_auto_20261018_1207'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarketSymbols',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('updated_at', models.DateTimeField()),
+                ('platform', models.CharField(choices=[('Binance', 'Binance')], default='Binance', max_length=100)),
+                ('symbol', models.CharField(max_length=20)),
+                ('asset', models.CharField(max_length=20)),
+                ('base', models.CharField(max_length=20)),
+                ('asset_precision', models.IntegerField()),
+                ('base_precision', models.IntegerField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='marketsymbols',
+            constraint=models.UniqueConstraint(fields=('platform', 'symbol'), name='No symbol duplicate'),
+        ),
+    ]
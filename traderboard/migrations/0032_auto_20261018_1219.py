@@ -0,0 +1,29 @@
+# Generated by Django 3.2.3 on 2026-10-18 12:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('traderboard', '0031_auto_20261018_1211'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountHistoryWindow',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('updated_at', models.DateTimeField()),
+                ('date_from', models.DateTimeField()),
+                ('date_to', models.DateTimeField()),
+                ('done', models.BooleanField(default=False)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='traderboard.tradingaccount')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='accounthistorywindow',
+            constraint=models.UniqueConstraint(fields=('account', 'date_from'), name='No history window duplicate'),
+        ),
+    ]
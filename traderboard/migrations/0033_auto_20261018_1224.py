@@ -0,0 +1,30 @@
+# Generated by Django 3.2.3 on 2026-10-18 12:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('traderboard', '0032_auto_20261018_1219'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountPositions',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('updated_at', models.DateTimeField()),
+                ('asset', models.CharField(max_length=20)),
+                ('last_buy_at', models.DateTimeField()),
+                ('last_buy_price_usdt', models.DecimalField(decimal_places=10, default=None, max_digits=30, null=True)),
+                ('last_buy_price_btc', models.DecimalField(decimal_places=10, default=None, max_digits=30, null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='traderboard.tradingaccount')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='accountpositions',
+            constraint=models.UniqueConstraint(fields=('account', 'asset'), name='No position duplicate'),
+        ),
+    ]
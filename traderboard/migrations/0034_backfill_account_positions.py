@@ -0,0 +1,53 @@
+from datetime import datetime, timezone
+from django.db import migrations
+
+
+def backfill_positions(apps, schema_editor):
+    '''Record the last buy of the assets held at the last snapshot of each account,
+       priced like the balance performance used to: with the trade price when the symbol is
+       quoted in the base, with the prices of the following snapshot otherwise.'''
+    TradingAccount = apps.get_model('traderboard', 'TradingAccount')
+    SnapshotAccount = apps.get_model('traderboard', 'SnapshotAccount')
+    SnapshotAccountDetails = apps.get_model('traderboard', 'SnapshotAccountDetails')
+    AccountTrades = apps.get_model('traderboard', 'AccountTrades')
+    AccountPositions = apps.get_model('traderboard', 'AccountPositions')
+    now = datetime.now(timezone.utc)
+
+    positions = []
+    for ta in TradingAccount.objects.all():
+        last_snap = SnapshotAccount.objects.filter(account=ta).order_by('-created_at').first()
+        assets = SnapshotAccountDetails.objects.filter(snapshot=last_snap).values_list('asset', flat=True)
+        for asset in assets:
+            last_buy = AccountTrades.objects.filter(account=ta, symbol__startswith=asset, side='BUY')\
+                                            .order_by('-created_at')\
+                                            .first()
+            if last_buy is None:
+                continue
+            snap = SnapshotAccount.objects.filter(account=ta, created_at__gte=last_buy.created_at)\
+                                          .order_by('created_at')\
+                                          .first()
+            detail = SnapshotAccountDetails.objects.filter(snapshot=snap, asset=asset).first()
+            price_usdt = detail.price_usdt if detail else None
+            price_btc = detail.price_btc if detail else None
+            if last_buy.symbol.endswith('USDT'):
+                price_usdt = last_buy.price
+            elif last_buy.symbol.endswith('BTC'):
+                price_btc = last_buy.price
+            positions.append(AccountPositions(account=ta,
+                                              updated_at=now,
+                                              asset=asset,
+                                              last_buy_at=last_buy.created_at,
+                                              last_buy_price_usdt=price_usdt,
+                                              last_buy_price_btc=price_btc))
+    AccountPositions.objects.bulk_create(positions, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('traderboard', '0033_auto_20261018_1224'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_positions, migrations.RunPython.noop),
+    ]
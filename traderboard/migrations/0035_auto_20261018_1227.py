@@ -0,0 +1,23 @@
+# Generated by Django 3.2.3 on 2026-10-18 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('traderboard', '0034_backfill_account_positions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshotaccount',
+            name='return_index_btc',
+            field=models.FloatField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='snapshotaccount',
+            name='return_index_usdt',
+            field=models.FloatField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+import numpy as np
+from django.db import migrations
+
+
+def backfill_return_index(apps, schema_editor):
+    '''Chain the return index of the snapshots of every account, with the relative PnL of the stats:
+       relative to the opening balance, or to the closing one minus the PnL after a deposit.'''
+    TradingAccount = apps.get_model('traderboard', 'TradingAccount')
+    SnapshotAccount = apps.get_model('traderboard', 'SnapshotAccount')
+    to_float = lambda x: np.nan if x is None else float(x)
+
+    for ta in TradingAccount.objects.all():
+        snaps = list(SnapshotAccount.objects.filter(account=ta).order_by('created_at', 'id'))
+        if not snaps:
+            continue
+        for suffix in ['btc', 'usdt']:
+            balance = np.array([to_float(getattr(snap, f'balance_{suffix}')) for snap in snaps])
+            pnl = np.array([to_float(getattr(snap, f'pnl_{suffix}')) for snap in snaps])
+            balance_open = np.roll(balance, 1)
+            balance_open[0] = np.nan
+            dep_wit = balance - balance_open - pnl
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pnl_rel = np.where(dep_wit > 0, pnl / (balance - pnl), pnl / balance_open)
+            pnl_rel[~np.isfinite(pnl_rel)] = 0.0
+            index = None
+            for snap, factor in zip(snaps, 1.0 + pnl_rel):
+                # the index of a wiped out account stays 0, a new chain starts from the next snapshot
+                index = (index or 1.0) * float(factor)
+                setattr(snap, f'return_index_{suffix}', index)
+        SnapshotAccount.objects.bulk_update(snaps, ['return_index_btc', 'return_index_usdt'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('traderboard', '0035_auto_20261018_1227'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_return_index, migrations.RunPython.noop),
+    ]
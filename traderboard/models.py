@@ -51,6 +51,10 @@ class SnapshotAccount(models.Model):
     # absolute PnL wrt last snapshot
     pnl_btc =  models.DecimalField(max_digits=30, decimal_places=10, default=None, null=True)
     pnl_usdt =  models.DecimalField(max_digits=30, decimal_places=10, default=None, null=True)
+    # cumulative time-weighted return since the first snapshot, the return of a window is the ratio
+    # of the indexes of its last and first snapshots
+    return_index_btc = models.FloatField(default=None, null=True)
+    return_index_usdt = models.FloatField(default=None, null=True)
 
     class Meta:
         constraints = [
@@ -102,6 +106,37 @@ class AccountTransactions(models.Model):
         ]
 
 
+class AccountPositions(models.Model):
+    '''Last buy of each asset of TradingAccount, prices are the ones at buy time'''
+    account = models.ForeignKey(TradingAccount, on_delete=models.CASCADE)
+    updated_at = models.DateTimeField()
+    asset = models.CharField(max_length=20)
+    last_buy_at = models.DateTimeField()
+    last_buy_price_usdt = models.DecimalField(max_digits=30, decimal_places=10, default=None, null=True)
+    last_buy_price_btc = models.DecimalField(max_digits=30, decimal_places=10, default=None, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'asset'], 
+                                    name='No position duplicate')
+        ]
+
+
+class AccountHistoryWindow(models.Model):
+    '''Window of the TradingAccount history to load, checkpoints the history backfill'''
+    account = models.ForeignKey(TradingAccount, on_delete=models.CASCADE)
+    updated_at = models.DateTimeField()
+    date_from = models.DateTimeField()
+    date_to = models.DateTimeField()
+    done = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'date_from'], 
+                                    name='No history window duplicate')
+        ]
+
+
 class SnapshotMarket(models.Model):
     '''Snapshot of the Market prices'''
     created_at = models.DateTimeField()
@@ -114,6 +149,59 @@ class SnapshotMarket(models.Model):
     asset = models.CharField(max_length=20, default='Unknown')
     base = models.CharField(max_length=20, default='Unknown')
     price = models.DecimalField(max_digits=30, decimal_places=10)
+    # 24h ticker statistics
+    open_price = models.DecimalField(max_digits=30, decimal_places=10, default=None, null=True)
+    high_price = models.DecimalField(max_digits=30, decimal_places=10, default=None, null=True)
+    low_price = models.DecimalField(max_digits=30, decimal_places=10, default=None, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['platform', 'created_at']),
+            models.Index(fields=['platform', 'symbol', 'created_at'])
+        ]
+
+
+class MarketSymbols(models.Model):
+    '''Symbols listed on a Market'''
+    updated_at = models.DateTimeField()
+    platform = models.CharField(max_length=100,
+                                choices=TradingPlatform.choices,
+                                default=TradingPlatform.BINANCE)
+
+    symbol = models.CharField(max_length=20)
+    asset = models.CharField(max_length=20)
+    base = models.CharField(max_length=20)
+    asset_precision = models.IntegerField()
+    base_precision = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['platform', 'symbol'], 
+                                    name='No symbol duplicate')
+        ]
+
+
+class MarketKlines(models.Model):
+    '''Closed candles of a Market symbol, times are in ms'''
+    platform = models.CharField(max_length=100,
+                                choices=TradingPlatform.choices,
+                                default=TradingPlatform.BINANCE)
+    symbol = models.CharField(max_length=20)
+    interval = models.CharField(max_length=3)
+    open_time = models.BigIntegerField()
+    close_time = models.BigIntegerField()
+    # prices are stored as floats to keep the precision of low priced symbols
+    open_price = models.FloatField()
+    high_price = models.FloatField()
+    low_price = models.FloatField()
+    close_price = models.FloatField()
+    volume = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['platform', 'symbol', 'interval', 'open_time'],
+                                    name='No kline duplicate')
+        ]
 
 
 @receiver(post_save, sender=User)
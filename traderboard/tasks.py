@@ -1,4 +1,3 @@
-import time
 from celery import shared_task
 from Trader import Trader
 from TradingClient import TradingClient
@@ -6,34 +5,39 @@ from Market import Market
 from Trader import Trader
 from datetime import datetime, timedelta, timezone
 from django.contrib.auth.models import User
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from decimal import Decimal
 from traderboard.models import (TradingAccount, 
                                 SnapshotAccount, 
                                 SnapshotAccountDetails, 
                                 AccountTrades, 
-                                AccountTransactions)
+                                AccountTransactions,
+                                AccountHistoryWindow,
+                                AccountPositions,
+                                SnapshotMarket)
 
 
 __PLATFORMS__ = ['Binance']
+HISTORY_WINDOW = timedelta(days=30)
 
 
-def take_snapshot(ta, market, now):
-    '''Take snapshot of a TradingAccount'''
+def take_snapshot(ta, market, now, balances=None):
+    '''Take snapshot of a TradingAccount, from its current balances if already fetched'''
     assert ta.platform == market.platform, f"Trading account and market\
         must belong to the same trading platform: {ta.platform} != {market.platform}"
-    tc = TradingClient.connect(ta)
-    # get balances
-    balance_btc = Decimal(tc.get_balances_value(market, 'BTC'))
-    balance_usdt = Decimal(tc.get_balances_value(market, 'USDT'))
-    # get balance details
-    balance_details = tc.get_balances()
+    tc = TradingClient.connect(ta, offline=balances is not None)
+    # fetch balances once, every figure of the snapshot is computed from them
+    if balances is None:
+        balances = tc.get_balances()
+    values = {base: tc.get_value_table(balances, market, base) for base in ['BTC', 'USDT']}
+    balance_btc = Decimal(values['BTC']['value'].sum())
+    balance_usdt = Decimal(values['USDT']['value'].sum())
 
     # Get pnL data wrt to last record 
     try:
         last_snap = SnapshotAccount.objects.filter(account=ta).latest('created_at')
-        pnl_btc = Decimal(tc.get_pnl(last_snap, now, market, 'BTC'))
-        pnl_usdt = Decimal(tc.get_pnl(last_snap, now, market, 'USDT'))
+        pnl_btc = Decimal(tc.get_pnl(last_snap, now, market, 'BTC', balances))
+        pnl_usdt = Decimal(tc.get_pnl(last_snap, now, market, 'USDT', balances))
     except Exception as e:
         print(f'No PnL can be computed for account {ta.id}.\nRoot error: {e}')
         last_snap = None
@@ -51,15 +55,18 @@ def take_snapshot(ta, market, now):
 
     try:
         snap.save()
+        tc.update_return_index(now)
+        Trader.expire_profiles(ta.user_id)
         # save account details
+        balance_details = balances.copy()
+        balance_details['price_usdt'] = values['USDT']['price']
+        balance_details['price_btc'] = values['BTC']['price']
         for record in balance_details.itertuples():
-            price_usdt = market.get_price(record.asset, 'USDT')['lastPrice']
-            price_btc = market.get_price(record.asset, 'BTC')['lastPrice']
             details = SnapshotAccountDetails(snapshot=snap, 
                                              asset=record.asset, 
                                              amount=Decimal(record.amount),
-                                             price_usdt=Decimal(price_usdt),
-                                             price_btc=Decimal(price_btc)
+                                             price_usdt=Decimal(record.price_usdt),
+                                             price_btc=Decimal(record.price_btc)
                                             )
             try:
                 details.save()
@@ -72,83 +79,93 @@ def take_snapshot(ta, market, now):
     return snap
 
 
-def update_profile(user, markets, now):
-    '''Update account level user stats'''
-    trader = Trader(user, markets)
-
-    # Get pnL data wrt to 24h record
+def get_window_pnl(trader, date_from, date_to, min_span):
+    '''Return the cumulative relative PnL of the trader between date_from and date_to,
+       None when the snapshots of the window span less than min_span'''
     try:
-        date_from = now - timedelta(days=1)
-        date_from = date_from.replace(microsecond=0, second=0, minute=0)
-        stats = trader.get_stats(date_from, now, base='USDT')
-        first_date = stats.iloc[0]['created_at'].to_pydatetime()
-        last_date = stats.iloc[-1]['created_at'].to_pydatetime()
-        if last_date - first_date > timedelta(hours=23):
-            daily_pnl = Decimal(stats.iloc[-1]['cum_pnl_rel'])
-        else:
-            daily_pnl = None
+        window = trader.get_window_return(date_from, date_to, base='USDT')
+        if window is None:
+            return None
+        first_date, last_date, cum_pnl_rel = window
+        if last_date - first_date > min_span:
+            return Decimal(cum_pnl_rel)
     except Exception as e:
         print(e)
-        daily_pnl = None
-    
-    # Get pnL data wrt to 7d record
-    try:
-        date_from = now - timedelta(days=7)
-        date_from = date_from.replace(microsecond=0, second=0, minute=0, hour=0)
-        stats = trader.get_stats(date_from, now, base='USDT')
-        first_date = stats.iloc[0]['created_at'].to_pydatetime()
-        last_date = stats.iloc[-1]['created_at'].to_pydatetime()
-        if last_date - first_date > timedelta(days=6, hours=12):
-            weekly_pnl = Decimal(stats.iloc[-1]['cum_pnl_rel'])
-        else:
-            weekly_pnl = None
-    except Exception as e:
-        print(e)
-        weekly_pnl = None
+    return None
+
+
+def update_profile(user, markets, now):
+    '''Update account level user stats'''
+    # stats only rely on recorded snapshots, recorded market prices are enough
+    trader = Trader(user, markets, offline=True)
+
+    # Get pnL data wrt to 24h, 7d and 1m records, windows must be covered by snapshots
+    daily_from = (now - timedelta(days=1)).replace(microsecond=0, second=0, minute=0)
+    weekly_from = (now - timedelta(days=7)).replace(microsecond=0, second=0, minute=0, hour=0)
+    monthly_from = (now - timedelta(days=30)).replace(microsecond=0, second=0, minute=0, hour=0)
+    daily_pnl = get_window_pnl(trader, daily_from, now, timedelta(hours=23))
+    weekly_pnl = get_window_pnl(trader, weekly_from, now, timedelta(days=6, hours=12))
+    monthly_pnl = get_window_pnl(trader, monthly_from, now, timedelta(days=29, hours=12))
 
-    # Get pnL data wrt to 1m record
-    try:
-        date_from = now - timedelta(days=30)
-        date_from = date_from.replace(microsecond=0, second=0, minute=0, hour=0)
-
-        stats = trader.get_stats(date_from, now, base='USDT')
-        first_date = stats.iloc[0]['created_at'].to_pydatetime()
-        if last_date - first_date > timedelta(days=29, hours=12):
-            monthly_pnl = Decimal(stats.iloc[-1]['cum_pnl_rel'])
-        else:
-            monthly_pnl = None
-    except Exception as e:
-        print(e)
-        monthly_pnl = None
-    
     # update main ranking metrics
     user.profile.daily_pnl = daily_pnl
     user.profile.weekly_pnl = weekly_pnl
     user.profile.monthly_pnl = monthly_pnl
     user.save()
+    Trader.expire_profiles(user.id)
 
     return user
 
 
+def take_market_snapshot(market, now):
+    '''Take snapshot of the prices of every traded symbol of a Market'''
+    table = market.table[market.table['lastId'] > 0]
+    snaps = [SnapshotMarket(created_at=now,
+                            updated_at=now,
+                            platform=market.platform,
+                            symbol=record.symbol,
+                            asset=record.baseAsset,
+                            base=record.quoteAsset,
+                            price=Decimal(record.lastPrice),
+                            open_price=Decimal(record.openPrice),
+                            high_price=Decimal(record.highPrice),
+                            low_price=Decimal(record.lowPrice))
+             for record in table.itertuples()]
+    SnapshotMarket.objects.bulk_create(snaps)
+    return snaps
+
+
 @shared_task
-def update_all_profile():
-    # Take time snapshot of market state
+def update_all_market():
+    '''Record the market prices, then update every profile with these same prices'''
     now = datetime.now(timezone.utc)
     markets = {platform : Market.connect(platform) for platform in __PLATFORMS__}
+    for market in markets.values():
+        take_market_snapshot(market, now)
+    update_all_profile(markets, now)
+
+
+@shared_task
+def update_all_profile(markets=None, now=None):
+    # Take time snapshot of market state
+    if not markets:
+        now = datetime.now(timezone.utc)
+        markets = {platform : Market.connect(platform) for platform in __PLATFORMS__}
     users = User.objects.all()
 
-    for i, user in enumerate(users):
-        # quick patch (TO REMOVE)
-        if i == 22:
-            time.sleep(60)
-        # Collect account level data
-        tas = TradingAccount.objects.filter(user=user)
-        for ta in tas:
-            try:
-                take_snapshot(ta, markets[ta.platform], now)
-            except Exception as e:
-                print(f"Error during snapshot of {ta.user.username} - account {ta.id}.")
-                print(e)
+    # Collect account level data, balances of every account are fetched concurrently
+    tas = list(TradingAccount.objects.select_related('user'))
+    balances = TradingClient.get_all_balances(tas)
+    for ta, ta_balances in zip(tas, balances):
+        try:
+            if isinstance(ta_balances, Exception):
+                raise ta_balances
+            take_snapshot(ta, markets[ta.platform], now, ta_balances)
+        except Exception as e:
+            print(f"Error during snapshot of {ta.user.username} - account {ta.id}.")
+            print(e)
+
+    for user in users:
         # Collect user level data
         update_profile(user, markets, now)
 
@@ -170,6 +187,7 @@ def record_transaction(event, ta_id):
                                     )
         try:
             trans.save()
+            Trader.expire_profiles(ta.user_id)
             print(f'Transaction of account {ta_id} recorded.')
         except IntegrityError as e:
             print('Transaction duplicate detected, record operation dismissed.')
@@ -178,6 +196,32 @@ def record_transaction(event, ta_id):
         raise Exception(f'Trading account {ta_id} does not exist.')
 
 
+def update_position(ta, market, symbol, price, date):
+    '''Record the buy of the asset of symbol at price (in quote units) as the last buy of this asset,
+       unless a later buy is already recorded'''
+    info = market.table[market.table['symbol'] == symbol]
+    if info.empty:
+        print(f'Symbol {symbol} not listed on {market.platform}, position not updated.')
+        return
+    asset, quote = info['baseAsset'].iat[0], info['quoteAsset'].iat[0]
+    # quotes without conversion are priced 0, leave them unknown
+    price_usdt = price * Decimal(market.get_price(quote, 'USDT')['lastPrice']) or None
+    price_btc = price * Decimal(market.get_price(quote, 'BTC')['lastPrice']) or None
+    updated = AccountPositions.objects.filter(account=ta, asset=asset, last_buy_at__lte=date)\
+                                      .update(updated_at=date,
+                                              last_buy_at=date,
+                                              last_buy_price_usdt=price_usdt,
+                                              last_buy_price_btc=price_btc)
+    if not updated:
+        position = AccountPositions(account=ta,
+                                    updated_at=date,
+                                    asset=asset,
+                                    last_buy_at=date,
+                                    last_buy_price_usdt=price_usdt,
+                                    last_buy_price_btc=price_btc)
+        AccountPositions.objects.bulk_create([position], ignore_conflicts=True)
+
+
 @shared_task
 def record_trade(event, ta_id):
     ta = TradingAccount.objects.get(id=ta_id)
@@ -204,7 +248,19 @@ def record_trade(event, ta_id):
                             )
         try:
             trade.save()
+            Trader.expire_profiles(ta.user_id)
             print(f'Trade of account {ta_id} recorded.')
+            if side == 'BUY':
+                # the trade is recorded, the position must not depend on the REST API
+                try:
+                    market = Market.shared(ta.platform)
+                except Exception as e:
+                    print(f'Market unavailable, position priced with the recorded prices.\nRoot error: {e}')
+                    market = None
+                try:
+                    update_position(ta, market or Market.shared(ta.platform, offline=True), symbol, price, date)
+                except Exception as e:
+                    print(f'Position of account {ta_id} not updated.\nRoot error: {e}')
         except IntegrityError as e:
             print('Trade duplicate detected, record operation dismissed.')
 
@@ -216,27 +272,64 @@ def record_trade(event, ta_id):
 
 @shared_task
 def load_account_history(user_id, ta_id, n_month):
-    '''Load past balance data at trading account registration'''
-    user = User.objects.get(id=user_id)
+    '''Load past balance data at trading account registration. The history is split in windows 
+       of HISTORY_WINDOW loaded concurrently, windows already loaded are skipped.
+       Running it again is the way to recover a backfill whose windows ran out of retries:
+       the pending windows are loaded again, or the backfill is finished if none is left.'''
     ta = TradingAccount.objects.get(id=ta_id)
-    market = Market.connect(ta.platform)
-    tc = TradingClient.connect(ta)
     now = datetime.now(timezone.utc)
+    # windows are anchored on the account creation so that a retry finds the same ones,
+    # they overlap by one day so that the first snapshot of each window gets its PnL
+    for i in range(n_month):
+        date_to = ta.created_at - i * (HISTORY_WINDOW - timedelta(days=1))
+        AccountHistoryWindow.objects.get_or_create(account=ta,
+                                                   date_from=date_to - HISTORY_WINDOW,
+                                                   defaults={'date_to': date_to, 'updated_at': now})
 
-    for _ in range(n_month):
-        try:
-            first_snap = SnapshotAccount.objects.filter(account=ta).earliest('created_at')
-            date_to = first_snap.created_at
-        except:
-            date_to = now
-            
-        date_from = date_to - timedelta(days=30)
-        tc.load_transaction_history(date_from, date_to)
-        print(f'Transaction history ({date_from} -> {date_to}) of accout {ta.id}\
-             loaded successfully.')
-        tc.load_snapshot_history(date_from, date_to, market)
-        print(f'Snapshot history  ({date_from} -> {date_to}) of account {ta.id}\
-             loaded succesfully.')
+    windows = AccountHistoryWindow.objects.filter(account=ta, done=False)
+    if windows:
+        for window in windows:
+            load_history_window.delay(user_id, window.id)
+    else:
+        finish_account_history(user_id, ta_id)
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=60, max_retries=3)
+def load_history_window(user_id, window_id):
+    '''Load one window of the history of a trading account, then finish the backfill
+       if it was the last window to load'''
+    window = AccountHistoryWindow.objects.get(id=window_id)
+    if window.done:
+        return
+    ta = window.account
+    market = Market.shared(ta.platform)
+    tc = TradingClient.connect(ta)
+
+    counts = tc.load_transaction_history(window.date_from, window.date_to)
+    print(f'Transaction history ({window.date_from} -> {window.date_to}) of accout {ta.id}\
+         loaded successfully (inserted, skipped): {counts}.')
+    counts = tc.load_snapshot_history(window.date_from, window.date_to, market)
+    print(f'Snapshot history  ({window.date_from} -> {window.date_to}) of account {ta.id}\
+         loaded succesfully (inserted, skipped): {counts}.')
 
+    # windows completing together are serialized by the account lock, so that only the last one finishes
+    with transaction.atomic():
+        TradingAccount.objects.select_for_update().get(id=ta.id)
+        window.done = True
+        window.updated_at = datetime.now(timezone.utc)
+        window.save()
+        last_window = not AccountHistoryWindow.objects.filter(account=ta, done=False).exists()
+    if last_window:
+        finish_account_history(user_id, ta.id)
+
+
+def finish_account_history(user_id, ta_id):
+    '''Snapshot the trading account and update the profile once its history is loaded'''
+    user = User.objects.get(id=user_id)
+    ta = TradingAccount.objects.get(id=ta_id)
+    market = Market.shared(ta.platform)
+    now = datetime.now(timezone.utc)
+    # windows are loaded concurrently, chain the return index once the whole history is recorded
+    TradingClient.connect(ta, offline=True).update_return_index()
     take_snapshot(ta, market, now)
-    update_profile(user, None, now)
\ No newline at end of file
+    update_profile(user, None, now)
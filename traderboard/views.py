@@ -76,16 +76,16 @@ def show_profile(request):
         if nacc_user > 0:
             form = ProfileFilterForm(request.GET)
             if form.is_valid():
-                profile = trader.get_profile(form.cleaned_data['date_from'], 
-                                             form.cleaned_data['date_to'], 
-                                             'USDT', 
-                                             False)
+                profile = trader.get_cached_profile(form.cleaned_data['date_from'], 
+                                                    form.cleaned_data['date_to'], 
+                                                    'USDT', 
+                                                    False)
             else:
                 # by default, show last week stats
                 now = datetime.now(timezone.utc)
                 date_from = datetime.combine(now - timedelta(days=7), datetime.min.time(), timezone.utc)
                 date_to = datetime.combine(now, datetime.max.time(), timezone.utc)
-                profile = trader.get_profile(date_from, date_to, 'USDT', False)
+                profile = trader.get_cached_profile(date_from, date_to, 'USDT', False)
              
         else:
             profile = {'overview': False, 'trader': user}
@@ -109,16 +109,16 @@ def show_overview_profile(request, pk=None):
         if nacc_req_user > 0 and nacc_user > 0:
             form = ProfileFilterForm(request.GET)
             if form.is_valid():
-                profile = trader.get_profile(form.cleaned_data['date_from'], 
-                                             form.cleaned_data['date_to'], 
-                                             'USDT', 
-                                             not user.profile.public)
+                profile = trader.get_cached_profile(form.cleaned_data['date_from'], 
+                                                    form.cleaned_data['date_to'], 
+                                                    'USDT', 
+                                                    not user.profile.public)
             else:
                 # by default, show last week stats
                 now = datetime.now(timezone.utc)
                 date_from = datetime.combine(now - timedelta(days=7), datetime.min.time(), timezone.utc)
                 date_to = datetime.combine(now, datetime.max.time(), timezone.utc)
-                profile = trader.get_profile(date_from, date_to, 'USDT', not user.profile.public)
+                profile = trader.get_cached_profile(date_from, date_to, 'USDT', not user.profile.public)
         else:
             profile = {'overview': True, 'trader': user}
             if nacc_req_user: